@@ -1,12 +1,19 @@
 import logging
-from logging.handlers import RotatingFileHandler
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
+from typing import List, Optional
 
 LOG_DIR = Path(__file__).resolve().parent
 AUDIT_LOG_FILE = LOG_DIR / "replication_audit.log"
 
+# Records are handed to a background thread so file writes and rotation never run on the event loop
+_listener: Optional[QueueListener] = None
+
 
 def get_audit_logger() -> logging.Logger:
+    global _listener
     logger = logging.getLogger("replication_audit")
     if logger.handlers:
         return logger
@@ -20,5 +27,41 @@ def get_audit_logger() -> logging.Logger:
         datefmt="%Y-%m-%dT%H:%M:%S%z",
     )
     handler.setFormatter(fmt)
-    logger.addHandler(handler)
-    return logger
\ No newline at end of file
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+    _listener = QueueListener(records, handler)
+    _listener.start()
+    logger.addHandler(QueueHandler(records))
+    return logger
+
+
+def stop_audit_listener() -> None:
+    """Write out queued audit records and stop the writer thread.
+
+    The queue handler is detached as well, so a later ``get_audit_logger`` call
+    in the same process sets up a fresh listener instead of queueing into nothing.
+    """
+    global _listener
+    logger = logging.getLogger("replication_audit")
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueHandler):
+            logger.removeHandler(handler)
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def tail_lines(path: Path, n: int, block_size: int = 8192) -> List[str]:
+    """Return the last ``n`` lines of ``path``, reading backwards from the end in blocks."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        # n + 1 newlines guarantee n complete lines even if the file ends with one
+        while pos > 0 and data.count(b"\n") <= n:
+            read_size = min(block_size, pos)
+            pos -= read_size
+            f.seek(pos)
+            data = f.read(read_size) + data
+    return [line.decode("utf-8", errors="replace") for line in data.splitlines()[-n:]]
\ No newline at end of file
@@ -39,6 +39,18 @@ def _get_fernet() -> Fernet:
     return Fernet(_ensure_secret_key())
 
 
+# Decrypted config keyed by the file's (mtime_ns, size); status polls reuse it until the file changes
+_config_cache: Dict[str, Any] = {"stamp": None, "config": None}
+
+
+def _file_stamp() -> Optional[tuple]:
+    try:
+        st = CONFIG_FILE.stat()
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
 def save_config(config: Dict[str, Any]) -> None:
     """Encrypt and persist replication configuration.
     Expected keys:
@@ -53,6 +65,7 @@ def save_config(config: Dict[str, Any]) -> None:
     payload = json.dumps(config).encode()
     token = f.encrypt(payload)
     CONFIG_FILE.write_bytes(token)
+    _config_cache["stamp"] = None
 
 
 def load_config() -> Dict[str, Any]:
@@ -64,14 +77,19 @@ def load_config() -> Dict[str, Any]:
         "password": None,
         "replication_enabled": False,
     }
-    if not CONFIG_FILE.exists():
+    stamp = _file_stamp()
+    if stamp is None:
         return defaults
+    if stamp == _config_cache["stamp"]:
+        return dict(_config_cache["config"])
     try:
         f = _get_fernet()
         token = CONFIG_FILE.read_bytes()
         data = json.loads(f.decrypt(token).decode())
         # Merge with defaults to avoid KeyError on older versions
         defaults.update({k: data.get(k) for k in defaults.keys()})
+        _config_cache["stamp"] = stamp
+        _config_cache["config"] = dict(defaults)
         return defaults
     except Exception:
         # If decryption fails, treat as no config
@@ -79,5 +97,6 @@ def load_config() -> Dict[str, Any]:
 
 
 def clear_config() -> None:
+    _config_cache["stamp"] = None
     if CONFIG_FILE.exists():
         CONFIG_FILE.unlink()
\ No newline at end of file
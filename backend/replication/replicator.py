@@ -187,6 +187,20 @@ class ReplicatingCollection:
         self._manager.enqueue({"op": "delete_many", "collection": self._name, "filter": filter})
         return result
 
+    async def find_one_and_update(self, filter: Dict[str, Any], update: Any, **kwargs):
+        result = await self._primary.find_one_and_update(filter, update, **kwargs)
+        if result is not None or kwargs.get("upsert"):
+            # The secondary only needs the write; projection/return_document are read-side options
+            replay_kwargs = {k: v for k, v in kwargs.items() if k in ("upsert", "array_filters")}
+            self._manager.enqueue({
+                "op": "update_one",
+                "collection": self._name,
+                "filter": filter,
+                "update": update,
+                "kwargs": replay_kwargs,
+            })
+        return result
+
     async def bulk_write(self, requests, **kwargs):
         result = await self._primary.bulk_write(requests, **kwargs)
         self._manager.enqueue({"op": "bulk_write", "collection": self._name, "requests": requests, "kwargs": kwargs})
@@ -1,40 +1,47 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request, UploadFile, File, Form, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from starlette.staticfiles import StaticFiles
 from starlette.routing import NoMatchFound
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, WriteConcern
+from pymongo.errors import DuplicateKeyError
 from replication.replicator import ReplicationManager, wrap_database
 from replication.config_store import load_config, save_config
-from replication.audit_logger import AUDIT_LOG_FILE
+from replication.audit_logger import AUDIT_LOG_FILE, stop_audit_listener, tail_lines
+from smtp_pool import SMTPPool, AsyncSMTPPool
 import os
 import logging
 import json
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr, ValidationError
 from typing import List, Optional, Union, Dict, Any, Set
-from functools import partial
 from enum import Enum
 import uuid
 from datetime import datetime, timezone, timedelta
-from collections import deque
+from collections import OrderedDict, deque
+from itertools import islice
 from jose import jwt
 from jose.exceptions import JWTError, ExpiredSignatureError
 from passlib.context import CryptContext
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
 import base64
 import io
 import csv
 import secrets
+import hashlib
 import re
 import httpx
+import orjson
+import jinja2
 import random
 import string
 import stripe
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 import unicodedata
+import time
 
 ROOT_DIR = Path(__file__).parent
 MEDIA_ROOT = ROOT_DIR / "media"
@@ -57,8 +64,25 @@ if env_specific_file.exists():
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Thread pool for blocking operations like email sending
-executor = ThreadPoolExecutor(max_workers=5)
+# Blocking SMTP sends run in worker threads; the semaphore caps how many run at once
+# so a burst of webhooks or imports cannot starve the default thread pool.
+EMAIL_SEND_CONCURRENCY = 8
+EMAIL_SEM = asyncio.Semaphore(EMAIL_SEND_CONCURRENCY)
+
+
+async def run_email_in_thread(func, *args, **kwargs):
+    async with EMAIL_SEM:
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+# Strong references to fire-and-forget tasks so they are not garbage collected mid-flight
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def spawn_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
@@ -71,8 +95,31 @@ logger.info("[Startup] Mongo primary database configured: DB_NAME=%s URL=%s", os
 replication_manager = ReplicationManager()
 db = wrap_database(_primary_db, replication_manager)
 
+# Near-static single-document settings collections (brevo_config, gamification_settings)
+# are cached per process; their update endpoints invalidate the entry.
+SINGLETON_CACHE_TTL_SECONDS = 30.0
+_singleton_cache: Dict[str, tuple] = {}
+
+
+async def cached_singleton(collection_name: str, ttl: float = SINGLETON_CACHE_TTL_SECONDS) -> Optional[dict]:
+    """Return the single settings document of a collection, served from a TTL cache."""
+    entry = _singleton_cache.get(collection_name)
+    now = time.monotonic()
+    if entry is not None and now < entry[1]:
+        return entry[0]
+    value = await db[collection_name].find_one({}, {"_id": 0})
+    _singleton_cache[collection_name] = (value, now + ttl)
+    return value
+
+
+def invalidate_singleton_cache(collection_name: str) -> None:
+    _singleton_cache.pop(collection_name, None)
+
 # Buffer em memória para monitorar últimos eventos de webhook do Stripe
 STRIPE_WEBHOOK_EVENTS_BUFFER = deque(maxlen=200)
+# Payloads above this size are recorded as a summary + hash unless debugging is on
+STRIPE_EVENT_MAX_RECORDED_PAYLOAD_BYTES = 4096
+STRIPE_WEBHOOK_DEBUG_PAYLOADS = os.environ.get('STRIPE_WEBHOOK_DEBUG_PAYLOADS', '').strip().lower() in ('1', 'true', 'yes', 'on')
 
 # Simple cache for Stripe config to reduce DB lookups
 STRIPE_CONFIG_CACHE_TTL_SECONDS = 300
@@ -82,6 +129,7 @@ _STRIPE_CONFIG_CACHE = {
 }
 
 INVITE_ID_PREFIX = "invite-"
+_TOKEN_TTL = timedelta(days=7)  # Validity of invitation / password creation tokens
 MAX_AVATAR_SIZE_BYTES = 5 * 1024 * 1024  # 5 MB
 
 
@@ -586,6 +634,39 @@ async def stripe_call_with_retry(func, *args, max_retries: int = 3, initial_dela
         await asyncio.sleep(delay)
         attempt += 1
 
+def _json_dumps(obj: Any) -> bytes:
+    """Fast JSON encoding for webhook payloads (orjson returns bytes)."""
+    return orjson.dumps(obj, default=str)
+
+
+_json_loads = orjson.loads
+
+
+_STRIPE_RECORDED_OBJECT_KEYS = ("id", "object", "customer", "subscription")
+
+
+def _trim_stripe_object(obj: Any) -> Any:
+    if not isinstance(obj, dict):
+        return obj
+    return {key: obj.get(key) for key in _STRIPE_RECORDED_OBJECT_KEYS if obj.get(key) is not None}
+
+
+def _summarize_stripe_payload(payload: bytes, payload_json: Any) -> dict:
+    """Compact stand-in for a large webhook payload kept in the monitoring buffer."""
+    summary = {
+        "_truncated": True,
+        "size": len(payload),
+        "sha256": hashlib.sha256(payload).hexdigest(),
+    }
+    if isinstance(payload_json, dict):
+        summary["id"] = payload_json.get("id")
+        summary["type"] = payload_json.get("type")
+        data_object = (payload_json.get("data") or {}).get("object")
+        summary.update(_trim_stripe_object(data_object) if isinstance(data_object, dict) else {})
+        summary.pop("object", None)
+    return summary
+
+
 def _record_stripe_event(entry: dict):
     try:
         entry["timestamp"] = datetime.now(timezone.utc).isoformat()
@@ -717,8 +798,15 @@ def _is_valid_base_url(url: str) -> bool:
     except Exception:
         return False
 
+class AppJSONResponse(ORJSONResponse):
+    """orjson-rendered responses; non-string dict keys are stringified like the stdlib encoder does."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
 # Create the main app
-app = FastAPI()
+app = FastAPI(default_response_class=AppJSONResponse)
 app.mount("/media", StaticFiles(directory=MEDIA_ROOT), name="media")
 api_router = APIRouter(prefix="/api")
 
@@ -769,6 +857,9 @@ class User(UserBase):
     subscription_status: Optional[str] = None  # inativa, ativa, ativa_ate_final_do_periodo, ativa_com_renovacao_automatica
     subscription_auto_renew: Optional[bool] = None  # True quando renovação automática estiver ativa
 
+# Only the fields the User model declares; skips progress/history arrays and secrets
+USER_PROJECTION = {"_id": 0, **{field: 1 for field in User.model_fields}}
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -1125,6 +1216,9 @@ class BulkImportRequest(BaseModel):
     course_ids: list[str] = []
     csv_content: str  # Base64 encoded CSV
 
+class BulkResendInviteRequest(BaseModel):
+    user_ids: list[str]  # Real user ids and/or synthetic invite ids
+
 class PasswordCreationToken(BaseModel):
     token: str
     email: str
@@ -1323,13 +1417,22 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def _authenticate_credentials(credentials: HTTPAuthorizationCredentials) -> "User":
-    if not credentials:
-        raise HTTPException(status_code=401, detail="Credenciais de autenticação são necessárias.")
+# Verified token payloads, so repeat requests with the same bearer token skip signature
+# checks; the user document is still loaded on every request
+TOKEN_PAYLOAD_CACHE_TTL_SECONDS = 30
+TOKEN_PAYLOAD_CACHE_MAX = 10000
+_token_payload_cache: "OrderedDict[str, tuple]" = OrderedDict()
 
-    token = credentials.credentials
-    last_error = None
 
+def _decode_access_token(token: str) -> dict:
+    cache_key = hashlib.sha256(token.encode()).hexdigest()[:32]
+    entry = _token_payload_cache.get(cache_key)
+    if entry is not None:
+        if time.time() < entry[1]:
+            return entry[0]
+        del _token_payload_cache[cache_key]
+
+    last_error = None
     for key in _KNOWN_SECRET_KEYS:
         try:
             payload = jwt.decode(token, key, algorithms=[ALGORITHM])
@@ -1345,6 +1448,22 @@ async def _authenticate_credentials(credentials: HTTPAuthorizationCredentials) -
         logger.exception("Failed to authenticate token: %s", last_error)
         raise HTTPException(status_code=401, detail="Invalid token") from last_error
 
+    # Never serve a cached payload past the token's own expiry
+    expires_at = time.time() + TOKEN_PAYLOAD_CACHE_TTL_SECONDS
+    if isinstance(payload.get("exp"), (int, float)):
+        expires_at = min(expires_at, payload["exp"])
+    _token_payload_cache[cache_key] = (payload, expires_at)
+    while len(_token_payload_cache) > TOKEN_PAYLOAD_CACHE_MAX:
+        _token_payload_cache.popitem(last=False)
+    return payload
+
+
+async def _authenticate_credentials(credentials: HTTPAuthorizationCredentials) -> "User":
+    if not credentials:
+        raise HTTPException(status_code=401, detail="Credenciais de autenticação são necessárias.")
+
+    payload = _decode_access_token(credentials.credentials)
+
     try:
         user_id: str = payload.get("sub")
         if user_id is None:
@@ -1851,7 +1970,7 @@ async def forgot_password(email: str):
         return {"message": "Se o email existir, você receberá instruções para redefinir sua senha"}
     
     # Get email settings
-    email_settings = await db.email_config.find_one({})
+    email_settings = await _get_email_config_async()
     
     if not email_settings:
         logger.error(f"❌ CRITICAL: Email settings not configured! Cannot send password reset to {email}")
@@ -1880,9 +1999,7 @@ async def forgot_password(email: str):
         reset_link = f"{frontend_url}/reset-password?token={reset_token}"
         
         # Send email using SMTP
-        loop = asyncio.get_event_loop()
-        loop.run_in_executor(
-            executor,
+        spawn_background_task(run_email_in_thread(
             send_brevo_email,
             email,
             user.get('name', 'Usuário'),
@@ -1903,7 +2020,7 @@ async def forgot_password(email: str):
             email_settings.get('sender_name', 'Hiperautomação'),
             email_settings.get('smtp_server', 'smtp-relay.brevo.com'),
             email_settings.get('smtp_port', 587)
-        )
+        ))
         
         logger.info(f"✅ Password reset email sent to {email}")
     except HTTPException as http_exc:
@@ -2656,20 +2773,60 @@ async def delete_lesson(lesson_id: str, current_user: User = Depends(get_current
 
 # ==================== ADMIN ROUTES - USER MANAGEMENT ====================
 
+# Stored user emails are not guaranteed lowercase; matched with this collation (and the
+# users.email index built with it) "Ana@x.com" and "ana@x.com" are the same address
+EMAIL_CASE_INSENSITIVE_COLLATION = {"locale": "en", "strength": 2}
+
+
 @api_router.get("/admin/users", response_model=List[User])
-async def get_all_users(current_user: User = Depends(get_current_admin)):
-    users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
-    
+async def get_all_users(
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    current_user: User = Depends(get_current_admin),
+):
+    """List users plus pending invitations.
+
+    Without ``limit`` everything is returned at once (up to 1000 users). With ``limit``
+    the users are paged by ``id``: pass the last ``id`` received as ``after`` to get the
+    next page. Pending invitations are appended to the last page only.
+    """
     # Get all existing course IDs to filter out deleted courses
     existing_courses = await db.courses.find({}, {"_id": 0, "id": 1}).to_list(1000)
     valid_course_ids = {course['id'] for course in existing_courses}
     existing_emails = set()
-    
-    # For each user, get their enrolled courses (only valid ones)
+
+    paginated = limit is not None
+    page_stages = []
+    if paginated:
+        page_stages = [
+            {"$match": {"id": {"$gt": after or ""}}},
+            {"$sort": {"id": 1}},
+            {"$limit": limit},
+        ]
+
+    # Join each user's enrollments in a single query; the course filter runs inside the
+    # lookup so enrollments of deleted courses never leave the enrollments scan
+    valid_ids = list(valid_course_ids)
+    users = await db.users.aggregate([
+        *page_stages,
+        {"$project": {"_id": 0, "password_hash": 0}},
+        {"$lookup": {
+            "from": "enrollments",
+            "localField": "id",
+            "foreignField": "user_id",
+            "pipeline": [
+                {"$match": {"course_id": {"$in": valid_ids}}},
+                {"$project": {"_id": 0, "course_id": 1}},
+            ],
+            "as": "_enrollments",
+        }},
+        {"$addFields": {"enrolled_courses": "$_enrollments.course_id"}},
+        {"$project": {"_enrollments": 0}},
+    ]).to_list(limit or 1000)
+    
+    # created_at is stored as an ISO string; the User response model parses it, so no
+    # per-user conversion is needed here
     for user in users:
-        if isinstance(user['created_at'], str):
-            user['created_at'] = datetime.fromisoformat(user['created_at'])
-        
         # Skip users without 'id' field (legacy users)
         if 'id' not in user:
             # Generate a temporary ID for legacy users or skip them
@@ -2680,15 +2837,6 @@ async def get_all_users(current_user: User = Depends(get_current_admin)):
             user['subscription_auto_renew'] = None
             continue
         
-        # Get enrolled courses from enrollments collection
-        enrollments = await db.enrollments.find({"user_id": user['id']}).to_list(1000)
-        # Filter to only include courses that still exist
-        user['enrolled_courses'] = [
-            enrollment['course_id'] 
-            for enrollment in enrollments 
-            if enrollment['course_id'] in valid_course_ids
-        ]
-
         # Enriquecer com informações de assinatura
         try:
             snapshot = build_subscription_snapshot(user)
@@ -2702,9 +2850,21 @@ async def get_all_users(current_user: User = Depends(get_current_admin)):
         if user.get("email"):
             existing_emails.add(user["email"].lower())
     
+    if paginated and len(users) == limit:
+        return users
+
     # Include pending invitations (users who received an invite link but have
     # not created their password / first login yet)
     pending_invites = await db.password_tokens.find({}, {"_id": 0}).to_list(1000)
+    if paginated:
+        # Earlier pages are not in existing_emails; check the invite emails against users directly
+        invite_emails = [invite["email"].lower() for invite in pending_invites if invite.get("email")]
+        async for existing in db.users.find(
+            {"email": {"$in": invite_emails}},
+            {"_id": 0, "email": 1},
+            collation=EMAIL_CASE_INSENSITIVE_COLLATION,
+        ):
+            existing_emails.add(existing["email"].lower())
     for invite in pending_invites:
         email = (invite.get("email") or "").lower()
         if email and email in existing_emails:
@@ -2757,11 +2917,11 @@ async def create_user_by_admin(user_data: UserCreate, current_user: User = Depen
     
     # Invitation flow (no password provided)
     token = secrets.token_urlsafe(32)
-    expires_at = datetime.now(timezone.utc) + timedelta(days=7)
-    now_iso = datetime.now(timezone.utc).isoformat()
+    now = datetime.now(timezone.utc)
+    expires_at = now + _TOKEN_TTL
+    now_iso = now.isoformat()
     if existing_invite:
         logger.info("Refreshing existing invitation for %s via admin UI", normalized_email)
-        combined_history = [token] + existing_invite.get("token_history", [])
         # Preserve original creation date if available
         created_at = existing_invite.get("created_at", now_iso)
         update_doc = {
@@ -2773,9 +2933,9 @@ async def create_user_by_admin(user_data: UserCreate, current_user: User = Depen
                 "course_ids": existing_invite.get("course_ids", []),
                 "expires_at": expires_at.isoformat(),
                 "updated_at": now_iso,
-                "token_history": list(dict.fromkeys(combined_history)),
                 "created_at": created_at,
-            }
+            },
+            "$addToSet": {"token_history": token},
         }
         await db.password_tokens.update_one({"_id": existing_invite["_id"]}, update_doc, upsert=True)
         token_data = await db.password_tokens.find_one({"_id": existing_invite["_id"]}, {"_id": 0})
@@ -2798,7 +2958,7 @@ async def create_user_by_admin(user_data: UserCreate, current_user: User = Depen
     invited_user = User(**pending_payload)
     
     # Attempt to send invitation email if configuration exists
-    email_config = await db.email_config.find_one({})
+    email_config = await _get_email_config_async()
     email_info = None
     if email_config and email_config.get('sender_email'):
         password_link = f"{os.environ.get('FRONTEND_URL', 'http://localhost:3000')}/create-password?token={token}"
@@ -2822,15 +2982,13 @@ async def create_user_by_admin(user_data: UserCreate, current_user: User = Depen
             </body>
         </html>
         """
-        loop = asyncio.get_event_loop()
         try:
             smtp_username = email_config.get('smtp_username') or email_config.get('sender_email')
             smtp_password = email_config.get('smtp_password') or email_config.get('brevo_smtp_key') or email_config.get('brevo_api_key')
             smtp_server = email_config.get('smtp_server', 'smtp-relay.brevo.com')
             smtp_port = email_config.get('smtp_port', 587)
             if smtp_username and smtp_password:
-                email_sent = await loop.run_in_executor(
-                    executor,
+                email_sent = await run_email_in_thread(
                     send_brevo_email,
                     normalized_email,
                     user_data.name,
@@ -2971,6 +3129,41 @@ async def delete_user_by_admin(user_id: str, current_user: User = Depends(get_cu
 
 # ==================== ADMIN ROUTES - SUBSCRIPTION PLANS ====================
 
+# stripe_price_id -> plan lookup used by the Stripe webhooks. The map is warmed at
+# startup and rebuilt on plan CRUD; since every worker process holds its own copy,
+# it is also rebuilt after a TTL and misses fall back to Mongo.
+PLAN_CACHE_PROJECTION = {"_id": 0, "id": 1, "access_scope": 1, "course_ids": 1, "duration_days": 1, "stripe_price_id": 1}
+PRICE_TO_PLAN_TTL_SECONDS = 300
+PRICE_TO_PLAN: Dict[str, dict] = {}
+_price_to_plan_loaded_at = 0.0
+
+
+async def load_price_to_plan() -> None:
+    global _price_to_plan_loaded_at
+    mapping = {}
+    async for plan in db.subscription_plans.find({"stripe_price_id": {"$type": "string"}}, PLAN_CACHE_PROJECTION):
+        mapping[plan["stripe_price_id"]] = plan
+    PRICE_TO_PLAN.clear()
+    PRICE_TO_PLAN.update(mapping)
+    _price_to_plan_loaded_at = time.monotonic()
+
+
+async def get_plan_by_price_id(price_id: Optional[str]) -> Optional[dict]:
+    if not price_id:
+        return None
+    if time.monotonic() - _price_to_plan_loaded_at > PRICE_TO_PLAN_TTL_SECONDS:
+        try:
+            await load_price_to_plan()
+        except Exception as exc:
+            logger.warning("Could not refresh stripe price -> plan cache: %s", exc)
+    plan = PRICE_TO_PLAN.get(price_id)
+    if plan is None:
+        plan = await db.subscription_plans.find_one({"stripe_price_id": price_id}, PLAN_CACHE_PROJECTION)
+        if plan:
+            PRICE_TO_PLAN[price_id] = plan
+    return plan
+
+
 @api_router.post("/admin/subscription-plans", response_model=SubscriptionPlan)
 async def create_subscription_plan(plan_data: SubscriptionPlanCreate, current_user: User = Depends(get_current_admin)):
     plan = SubscriptionPlan(**plan_data.model_dump())
@@ -2978,6 +3171,7 @@ async def create_subscription_plan(plan_data: SubscriptionPlanCreate, current_us
     plan_dict['created_at'] = plan_dict['created_at'].isoformat()
     
     await db.subscription_plans.insert_one(plan_dict)
+    await load_price_to_plan()
     return plan
 
 @api_router.get("/admin/subscription-plans", response_model=List[SubscriptionPlan])
@@ -2996,6 +3190,7 @@ async def update_subscription_plan(plan_id: str, plan_data: SubscriptionPlanBase
     
     update_data = plan_data.model_dump(exclude_unset=True)
     await db.subscription_plans.update_one({"id": plan_id}, {"$set": update_data})
+    await load_price_to_plan()
     
     updated = await db.subscription_plans.find_one({"id": plan_id}, {"_id": 0})
     if isinstance(updated['created_at'], str):
@@ -3007,6 +3202,7 @@ async def delete_subscription_plan(plan_id: str, current_user: User = Depends(ge
     result = await db.subscription_plans.delete_one({"id": plan_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Subscription plan not found")
+    await load_price_to_plan()
     return {"message": "Subscription plan deleted successfully"}
 
 # Public: List active subscription plans for students to subscribe
@@ -3400,9 +3596,10 @@ async def get_course_progress(course_id: str, current_user: User = Depends(get_c
 
 # ==================== HELPER FUNCTIONS ====================
 
-async def user_has_access(user_id: str) -> bool:
+async def user_has_access(user_id: str, user: Optional[dict] = None) -> bool:
     """Check if user has access to at least one course or has full access"""
-    user = await db.users.find_one({"id": user_id})
+    if user is None:
+        user = await db.users.find_one({"id": user_id})
     if not user:
         return False
     
@@ -4060,6 +4257,7 @@ async def save_email_config(config: EmailConfig, current_user: User = Depends(ge
         )
 
         result = await db.email_config.replace_one({}, config_dict, upsert=True)
+        invalidate_email_config_cache()
         logger.info(
             "Email configuration saved by admin %s (matched=%s, modified=%s, upserted_id=%s)",
             current_user.id,
@@ -5535,7 +5733,6 @@ async def admin_save_analytics_config(config: AnalyticsConfig, current_user: Use
 def send_brevo_email(to_email: str, to_name: str, subject: str, html_content: str, smtp_username: str, smtp_password: str, sender_email: str, sender_name: str, smtp_server: str = 'smtp-relay.brevo.com', smtp_port: int = 587):
     """Send email using SMTP"""
     try:
-        import smtplib
         from email.mime.text import MIMEText
         from email.mime.multipart import MIMEMultipart
         
@@ -5548,11 +5745,8 @@ def send_brevo_email(to_email: str, to_name: str, subject: str, html_content: st
         part = MIMEText(html_content, 'html')
         msg.attach(part)
         
-        # Send via SMTP
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_username, smtp_password)
-            server.send_message(msg)
+        # Send via pooled SMTP connection
+        smtp_pool.send_message(smtp_server, smtp_port, smtp_username, smtp_password, msg)
         
         logger.info(f"Email sent successfully to {to_email} via SMTP")
         return True
@@ -5569,7 +5763,7 @@ async def bulk_import_users(request: BulkImportRequest, current_user: User = Dep
     try:
         logger.info("Starting bulk import...")
         # Get email configuration (optional)
-        email_config = await db.email_config.find_one({})
+        email_config = await _get_email_config_async()
         if not email_config:
             logger.warning("Email configuration not found. Invitations will be created but emails will not be sent.")
         else:
@@ -5648,7 +5842,7 @@ async def bulk_import_users(request: BulkImportRequest, current_user: User = Dep
 
                 now = datetime.now(timezone.utc)
                 now_iso = now.isoformat()
-                expires_at = (now + timedelta(days=7)).isoformat()
+                expires_at = (now + _TOKEN_TTL).isoformat()
                 token = secrets.token_urlsafe(32)
 
                 if existing_invite:
@@ -5667,10 +5861,12 @@ async def bulk_import_users(request: BulkImportRequest, current_user: User = Dep
                         "course_ids": [] if request.has_full_access else new_courses,
                         "expires_at": expires_at,
                         "updated_at": now_iso,
-                        "token_history": list(dict.fromkeys([token] + existing_invite.get("token_history", []))),
                         "created_at": existing_invite.get("created_at", now_iso),
                     }
-                    await db.password_tokens.update_one({"_id": existing_invite["_id"]}, {"$set": update_doc})
+                    await db.password_tokens.update_one(
+                        {"_id": existing_invite["_id"]},
+                        {"$set": update_doc, "$addToSet": {"token_history": token}},
+                    )
                     token_data = update_doc
                 else:
                     token_data = {
@@ -5722,7 +5918,6 @@ async def bulk_import_users(request: BulkImportRequest, current_user: User = Dep
                 """
 
                 if email_sending_enabled:
-                    loop = asyncio.get_event_loop()
                     try:
                         smtp_username = email_config.get('smtp_username')
                         smtp_password = email_config.get('smtp_password')
@@ -5733,8 +5928,7 @@ async def bulk_import_users(request: BulkImportRequest, current_user: User = Dep
                             smtp_username = email_config.get('sender_email')
                             smtp_password = email_config.get('brevo_smtp_key') or email_config.get('brevo_api_key')
                         
-                        email_sent = await loop.run_in_executor(
-                            executor,
+                        email_sent = await run_email_in_thread(
                             send_brevo_email,
                             email,
                             name,
@@ -5885,7 +6079,7 @@ async def resend_password_token(request: PasswordTokenResendRequest):
 
     new_token = secrets.token_urlsafe(32)
     now = datetime.now(timezone.utc)
-    new_expiration = (now + timedelta(days=7)).isoformat()
+    new_expiration = (now + _TOKEN_TTL).isoformat()
     now_iso = now.isoformat()
 
     token_doc = await db.password_tokens.find_one(match_query)
@@ -5920,15 +6114,11 @@ async def resend_password_token(request: PasswordTokenResendRequest):
         try:
             frontend_url = get_frontend_url()
             password_link = f"{frontend_url}/create-password?token={new_token}"
-            loop = asyncio.get_running_loop()
-            await loop.run_in_executor(
-                executor,
-                partial(
-                    send_password_creation_email,
-                    email,
-                    name,
-                    password_link,
-                ),
+            await enqueue_email(
+                "password_creation",
+                email,
+                {"name": name, "password_link": password_link},
+                idempotency_key=f"password_creation:{new_token}",
             )
             logger.info("Reenviado link de criação de senha para %s", email)
         except Exception as exc:
@@ -5979,15 +6169,11 @@ async def resend_password_token(request: PasswordTokenResendRequest):
     try:
         frontend_url = get_frontend_url()
         password_link = f"{frontend_url}/create-password?token={new_token}"
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(
-            executor,
-            partial(
-                send_password_creation_email,
-                email,
-                name,
-                password_link,
-            ),
+        await enqueue_email(
+            "password_creation",
+            email,
+            {"name": name, "password_link": password_link},
+            idempotency_key=f"password_creation:{new_token}",
         )
         logger.info("Reenviado link de criação de senha (user_doc) para %s", email)
     except Exception as exc:
@@ -6285,9 +6471,49 @@ async def update_payment_settings(
 
     return {"message": "Stripe settings updated. Reinicie o backend para garantir que variáveis sejam recarregadas."}
 
+# Status forwarding runs off the webhook request path: events are queued and
+# delivered by a few workers sharing one keep-alive HTTP client, so a slow
+# client endpoint never delays the acknowledgement sent back to Stripe.
+FORWARD_QUEUE_MAXSIZE = 1000
+FORWARD_WORKER_COUNT = 8
+FORWARD_MAX_ATTEMPTS = 5
+FORWARD_RETRY_INITIAL_DELAY = 0.5
+FORWARD_RETRY_MAX_DELAY = 8.0
+
+_forward_queue: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=FORWARD_QUEUE_MAXSIZE)
+_forward_workers: List[asyncio.Task] = []
+_forward_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_forward_http_client() -> httpx.AsyncClient:
+    global _forward_http_client
+    if _forward_http_client is None or _forward_http_client.is_closed:
+        _forward_http_client = httpx.AsyncClient(
+            timeout=5.0,
+            limits=httpx.Limits(max_keepalive_connections=32),
+        )
+    return _forward_http_client
+
+
+def _enqueue_status_forward(payload: dict) -> None:
+    """Queue a normalized status for forwarding, dropping the oldest entry when full."""
+    while True:
+        try:
+            _forward_queue.put_nowait(payload)
+            return
+        except asyncio.QueueFull:
+            try:
+                dropped = _forward_queue.get_nowait()
+                _forward_queue.task_done()
+                logger.warning("Forward queue full; dropping oldest status (type=%s)", dropped.get("type"))
+            except asyncio.QueueEmpty:
+                pass
+
+
 async def _forward_status_to_client(payload: dict):
     """Forward normalized payment/subscription status to external webhook if configured.
     Respects 'forward_test_events' to skip test-mode events when disabled.
+    Transport errors and 5xx responses are retried with exponential backoff.
     """
     try:
         settings = await db.payment_settings.find_one({}, {"_id": 0})
@@ -6298,12 +6524,108 @@ async def _forward_status_to_client(payload: dict):
         # If test events should be skipped
         if (payload.get("livemode") is False) and (not allow_test):
             return
-        async with httpx.AsyncClient() as client:
-            await client.post(url, json=payload, timeout=5.0)
+        body = _json_dumps(payload)
+        client = _get_forward_http_client()
+        for attempt in range(FORWARD_MAX_ATTEMPTS):
+            try:
+                response = await client.post(url, content=body, headers={"content-type": "application/json"})
+                if response.status_code < 500:
+                    return
+                logger.warning("External webhook returned %s (attempt %s/%s)", response.status_code, attempt + 1, FORWARD_MAX_ATTEMPTS)
+            except httpx.TransportError as exc:
+                logger.warning("External webhook unreachable (attempt %s/%s): %s", attempt + 1, FORWARD_MAX_ATTEMPTS, exc)
+            if attempt + 1 < FORWARD_MAX_ATTEMPTS:
+                delay = min(FORWARD_RETRY_MAX_DELAY, FORWARD_RETRY_INITIAL_DELAY * (2 ** attempt))
+                await asyncio.sleep(delay + random.uniform(0, delay * 0.2))
+        logger.warning("Giving up forwarding status %s to external webhook", payload.get("type"))
     except Exception:
         # Don't break webhook processing if forwarding fails
         logger.warning("Failed to forward status to external webhook", exc_info=True)
 
+
+async def _forward_status_worker():
+    while True:
+        payload = await _forward_queue.get()
+        try:
+            await _forward_status_to_client(payload)
+        finally:
+            _forward_queue.task_done()
+
+
+class MongoBatcher:
+    """Coalesces keyed upserts on one collection into a single unordered bulk_write.
+
+    Updates submitted within the same window are merged per key: ``$set`` fields
+    are last-write-wins and ``$setOnInsert`` keeps the first value seen. Callers
+    await the flush, so a write is durable once ``submit`` returns.
+    """
+
+    def __init__(self, collection_name: str, key_field: str, window_seconds: float = 0.02):
+        self.collection_name = collection_name
+        self.key_field = key_field
+        self.window_seconds = window_seconds
+        self._pending: Dict[Any, dict] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def submit(self, key: Any, set_fields: dict, set_on_insert: Optional[dict] = None) -> None:
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = {"set": {}, "set_on_insert": {}, "waiters": []}
+            self._pending[key] = entry
+        entry["set"].update(set_fields or {})
+        for field, value in (set_on_insert or {}).items():
+            entry["set_on_insert"].setdefault(field, value)
+        waiter = asyncio.get_running_loop().create_future()
+        entry["waiters"].append(waiter)
+        if self._flush_task is None:
+            self._flush_task = spawn_background_task(self._flush_after_window())
+        await waiter
+
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window_seconds)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        requests = []
+        for key, entry in pending.items():
+            update: Dict[str, dict] = {}
+            if entry["set"]:
+                update["$set"] = entry["set"]
+            # A field cannot appear in both operators; $set already covers it
+            set_on_insert = {k: v for k, v in entry["set_on_insert"].items() if k not in entry["set"]}
+            if set_on_insert:
+                update["$setOnInsert"] = set_on_insert
+            if update:
+                requests.append(UpdateOne({self.key_field: key}, update, upsert=True))
+        error: Optional[BaseException] = None
+        if requests:
+            try:
+                await db[self.collection_name].bulk_write(requests, ordered=False)
+            except Exception as exc:
+                logger.error("Batched upsert on %s failed (%s keys): %s", self.collection_name, len(requests), exc)
+                error = exc
+        for entry in pending.values():
+            for waiter in entry["waiters"]:
+                if waiter.done():
+                    continue
+                if error is not None:
+                    waiter.set_exception(error)
+                else:
+                    waiter.set_result(None)
+
+
+billing_batcher = MongoBatcher("billings", "billing_id")
+
+
+async def submit_billing(billing_id: str, set_fields: dict, set_on_insert: Optional[dict] = None) -> None:
+    """Upsert a billing through the shared batcher (one bulk_write per 20 ms window)."""
+    await billing_batcher.submit(billing_id, set_fields, set_on_insert)
+
+
 # Admin: Get statistics
 @api_router.get("/admin/statistics")
 async def get_admin_statistics(current_user: User = Depends(get_current_admin)):
@@ -6495,10 +6817,7 @@ async def admin_sync_user_subscription(email: EmailStr, current_user: User = Dep
 
         plan_doc = None
         if price_id:
-            plan_doc = await db.subscription_plans.find_one(
-                {"stripe_price_id": price_id},
-                {"_id": 0, "id": 1, "access_scope": 1, "course_ids": 1, "duration_days": 1},
-            )
+            plan_doc = await get_plan_by_price_id(price_id)
 
         # Compute validity
         valid_until = None
@@ -6576,671 +6895,763 @@ async def admin_sync_user_subscription(email: EmailStr, current_user: User = Dep
 
 # ==================== STRIPE WEBHOOK ====================
 
-@api_router.post("/webhook/stripe")
-async def stripe_webhook(request: Request):
-    logger.info("🔔 Received Stripe webhook request")
-    
-    webhook_secret = os.environ.get('STRIPE_WEBHOOK_SECRET') or STRIPE_WEBHOOK_SECRET
-    if not webhook_secret:
-        # Try reading from payment_settings in DB as a fallback
-        try:
-            settings = await db.payment_settings.find_one({}, {"_id": 0})
-            if settings and settings.get("stripe_webhook_secret"):
-                webhook_secret = settings["stripe_webhook_secret"]
-                os.environ['STRIPE_WEBHOOK_SECRET'] = webhook_secret
-        except Exception:
-            pass
-    if not webhook_secret:
-        logger.error("Stripe webhook secret not configured")
-        raise HTTPException(status_code=500, detail="Stripe webhook not configured")
+STRIPE_INVOICE_SUCCESS_EVENTS = ("invoice.payment_succeeded", "invoice.paid")
 
-    payload = await request.body()
-    payload_text = ""
-    payload_json = None
-    if payload:
+# Structured validation applied to data.object before dispatch
+STRIPE_EVENT_MODELS = {
+    "checkout.session.completed": StripeCheckoutSession,
+    "invoice.payment_succeeded": StripeInvoice,
+    "invoice.paid": StripeInvoice,
+}
+
+# Recently processed event ids; Stripe redelivers events it did not see acknowledged
+STRIPE_PROCESSED_EVENT_IDS_MAX = 1000
+_processed_stripe_event_ids: "OrderedDict[str, None]" = OrderedDict()
+
+
+def _mark_stripe_event_processed(event_id: Optional[str]) -> None:
+    if not event_id:
+        return
+    _processed_stripe_event_ids[event_id] = None
+    _processed_stripe_event_ids.move_to_end(event_id)
+    while len(_processed_stripe_event_ids) > STRIPE_PROCESSED_EVENT_IDS_MAX:
+        _processed_stripe_event_ids.popitem(last=False)
+
+
+class StripeWebhookContext:
+    """Per-request state shared by the Stripe event handlers."""
+
+    def __init__(self, now: datetime, recorded_payload_json: Any, recorded_payload_raw: Optional[str], keep_full_payload: bool):
+        self.now = now
+        self.now_iso = now.isoformat()
+        self.recorded_payload_json = recorded_payload_json
+        self.recorded_payload_raw = recorded_payload_raw
+        self.keep_full_payload = keep_full_payload
+
+    def recorded_object(self, obj: Any) -> Any:
+        return obj if self.keep_full_payload else _trim_stripe_object(obj)
+
+
+async def _handle_stripe_payment_succeeded(event, data_obj: dict, ctx: StripeWebhookContext) -> dict:
+    """checkout.session.completed / invoice.paid: grant access and record the billing."""
+    event_type = event.get("type")
+    event_id = event.get("id")
+    livemode = bool(event.get("livemode", False))
+    data_id, sub_field, customer_id = data_obj.get("id"), data_obj.get("subscription"), data_obj.get("customer")
+    meta = data_obj.get("metadata") or {}
+    user_id = meta.get("user_id") or data_obj.get("client_reference_id")
+    plan_id = meta.get("subscription_plan_id")
+    access_scope = meta.get("access_scope") or "full"
+    raw_course_ids = meta.get("course_ids") or ""
+    if isinstance(raw_course_ids, list):
+        course_ids = [str(c) for c in raw_course_ids if c]
+    else:
+        course_ids = [c for c in str(raw_course_ids).split(",") if c]
+    try:
+        duration_days = int(meta.get("duration_days") or 0)
+    except (TypeError, ValueError):
+        duration_days = 0
+    customer_email = data_obj.get("customer_email") or ((data_obj.get("customer_details") or {}).get("email"))
+
+    # Capture monetary information (Stripe reports cents)
+    raw_currency = data_obj.get("currency")
+    currency = raw_currency.upper() if raw_currency else None
+    if event_type == "checkout.session.completed":
+        amount_cents = data_obj.get("amount_total") or data_obj.get("amount_subtotal")
+    else:
+        amount_cents = data_obj.get("amount_paid") or data_obj.get("amount_due")
+
+    price_id = None
+    sub = None
+    if event_type in STRIPE_INVOICE_SUCCESS_EVENTS:
+        line_items = ((data_obj.get("lines") or {}).get("data") or [])
+        if line_items:
+            first_line = line_items[0] or {}
+            price_data = first_line.get("price") or {}
+            price_id = price_data.get("id") or price_data.get("price_id")
+            if not currency:
+                price_currency = price_data.get("currency")
+                if price_currency:
+                    currency = price_currency.upper()
+
+    subscription_id = sub_field
+    if not subscription_id and event_type == "checkout.session.completed":
+        session_id = data_id
+        if session_id:
+            try:
+                session_lookup = await stripe_call_with_retry(
+                    stripe.checkout.Session.retrieve,
+                    session_id,
+                    expand=["subscription"],
+                )
+                sub_obj = session_lookup.get("subscription")
+                if sub_obj and isinstance(sub_obj, dict):
+                    subscription_id = sub_obj.get("id")
+                    sub = sub_obj
+            except Exception as e:
+                logger.warning(f"Stripe: failed to expand subscription from session {session_id}: {e}")
+    if subscription_id and sub is None:
         try:
-            payload_text = payload.decode("utf-8")
-        except Exception:
-            payload_text = payload.decode("utf-8", errors="replace")
+            sub = await stripe_call_with_retry(stripe.Subscription.retrieve, subscription_id)
+        except Exception as e:
+            logger.warning(f"Could not retrieve Stripe subscription {subscription_id}: {e}")
+
+    if not price_id and sub is not None:
         try:
-            payload_json = json.loads(payload_text)
+            sub_items = ((sub or {}).get("items", {}) or {}).get("data", [])
+            if sub_items:
+                price_obj = sub_items[0].get("price") or {}
+                price_id = price_obj.get("id") or price_obj.get("price_id")
         except Exception:
-            payload_json = None
-    sig_header = request.headers.get("Stripe-Signature")
+            price_id = price_id
 
-    logger.info(f"📝 Webhook payload size: {len(payload)} bytes")
-    logger.info(f"🔐 Signature header present: {bool(sig_header)}")
-    logger.info(f"🔑 Using webhook secret: {webhook_secret[:10]}...")
-    try:
-        replication_manager.audit.info(
-            f"stripe_webhook_received size={len(payload)} signature_present={bool(sig_header)}"
+    plan_doc = None
+    if plan_id:
+        plan_doc = await db.subscription_plans.find_one(
+            {"id": plan_id},
+            {"_id": 0, "id": 1, "access_scope": 1, "course_ids": 1, "duration_days": 1, "stripe_price_id": 1},
         )
-    except Exception:
-        pass
-    _record_stripe_event({
-        "stage": "received",
-        "type": "unknown",
-        "payload_size": len(payload),
-        "signature_present": bool(sig_header),
-        "payload_json": payload_json,
-        "payload_raw": payload_text if payload_json is None else None,
-    })
+    if not plan_doc and price_id:
+        plan_doc = await get_plan_by_price_id(price_id)
+        if plan_doc:
+            plan_id = plan_doc.get("id")
+
+    if plan_doc:
+        access_scope = plan_doc.get("access_scope", access_scope or "full")
+        if access_scope == "specific" and not course_ids:
+            course_ids = [str(c) for c in plan_doc.get("course_ids", []) if c]
+        if duration_days <= 0:
+            duration_days = int(plan_doc.get("duration_days", 0) or 0)
+
+    if access_scope != "specific":
+        course_ids = []
+
+    if not user_id and customer_id:
+        user_doc = await db.users.find_one(
+            {"stripe_customer_id": customer_id},
+            {"_id": 0, "id": 1, "email": 1, "subscription_plan_id": 1},
+        )
+        if user_doc:
+            user_id = user_doc.get("id")
+            if not plan_id:
+                plan_id = user_doc.get("subscription_plan_id") or plan_id
+            if not customer_email:
+                customer_email = user_doc.get("email")
+    if not user_id and customer_email:
+        user_doc = await db.users.find_one(
+            {"email": customer_email},
+            {"_id": 0, "id": 1, "subscription_plan_id": 1},
+        )
+        if user_doc:
+            user_id = user_doc.get("id")
+            if not plan_id:
+                plan_id = user_doc.get("subscription_plan_id") or plan_id
 
-    try:
-        event = await stripe_call_with_retry(
-            stripe.Webhook.construct_event,
-            payload=payload,
-            sig_header=sig_header,
-            secret=webhook_secret,
+    if not user_id or not plan_id:
+        # If we have customer email and a plan, create a new user automatically
+        if customer_email and plan_id:
+            try:
+                logger.info(f"Stripe: creating user for {customer_email} from webhook event {event_type}")
+                new_user_id = str(uuid.uuid4())
+                # Generate password creation token
+                password_token = secrets.token_urlsafe(32)
+                password_token_expires_iso = (ctx.now + _TOKEN_TTL).isoformat()
+                # Try to derive a display name from email
+                display_name = (customer_email.split("@", 1)[0] or "").replace(".", " ").title()
+                # Build base user doc
+                base_user = {
+                    "id": new_user_id,
+                    "email": customer_email,
+                    "name": display_name,
+                    "password": None,
+                    "role": "student",
+                    "avatar": None,
+                    "has_purchased": True,
+                    "created_at": ctx.now_iso,
+                    "created_via": "stripe",
+                    "password_creation_token": password_token,
+                    "password_token_expires": password_token_expires_iso,
+                    "password_token_history": [password_token],
+                    "stripe_customer_id": customer_id,
+                }
+                await db.users.insert_one(base_user)
+                user_id = new_user_id
+                # Send password creation email
+                try:
+                    frontend_url = get_frontend_url()
+                    password_link = f"{frontend_url}/create-password?token={password_token}"
+                    await enqueue_email(
+                        "password_creation",
+                        customer_email,
+                        {"name": display_name, "password_link": password_link},
+                        idempotency_key=f"password_creation:{password_token}",
+                    )
+                except Exception as e:
+                    logger.warning(f"Stripe: failed to enqueue password creation email: {e}")
+            except Exception as e:
+                logger.warning(f"Stripe: could not create user for {customer_email}: {e}")
+        else:
+            logger.warning(
+                f"Stripe webhook missing identifiers after resolution (event={event_type}, customer={customer_id}, email={customer_email}, price_id={price_id})"
+            )
+            _record_stripe_event({
+                "stage": "ignored",
+                "type": event_type,
+                "event_id": event_id,
+                "reason": "missing_identifiers",
+                "customer_id": customer_id,
+                "customer_email": customer_email,
+                "payload_json": ctx.recorded_payload_json,
+                "payload_raw": ctx.recorded_payload_raw,
+            })
+            return {"status": "ignored"}
+
+    # Try to derive validity from Stripe subscription if available
+    valid_until = None
+    if sub is not None:
+        current_period_end = sub.get("current_period_end")
+        if current_period_end:
+            try:
+                valid_until = datetime.fromtimestamp(int(current_period_end), tz=timezone.utc)
+                logger.info(f"Stripe: derived valid_until from subscription {subscription_id}: {valid_until.isoformat()}")
+            except Exception as e:
+                logger.warning(f"Stripe: failed to parse current_period_end for {subscription_id}: {e}")
+
+    subscription_auto_renew = None
+    if sub is not None:
+        subscription_auto_renew = not bool(sub.get("cancel_at_period_end"))
+    elif subscription_id:
+        subscription_auto_renew = True
+
+    if not valid_until and duration_days > 0:
+        valid_until = ctx.now + timedelta(days=duration_days)
+    status_value = determine_subscription_status(plan_id, valid_until, subscription_auto_renew)
+    update_payload_base = {
+        "has_purchased": True,
+        "subscription_plan_id": plan_id,
+        "subscription_auto_renew": subscription_auto_renew,
+        "subscription_status": status_value,
+        **({"stripe_customer_id": customer_id} if customer_id else {}),
+    }
+    if valid_until:
+        update_payload_base["subscription_valid_until"] = valid_until.isoformat()
+
+    if access_scope == "full":
+        update_payload = {
+            **update_payload_base,
+            "has_full_access": True,
+        }
+        await db.users.update_one(
+            {"id": user_id},
+            {
+                "$set": update_payload,
+                "$unset": {
+                    "subscription_cancelled": "",
+                    "subscription_cancel_at_period_end": "",
+                },
+            },
         )
-        logger.info(f"✅ Webhook signature verified successfully")
+        logger.info(f"Stripe: full access activated for user {user_id} until {valid_until.isoformat() if valid_until else 'unknown'}")
         try:
-            replication_manager.audit.info(
-                f"stripe_webhook_verified type={event.get('type')} id={event.get('id')} livemode={bool(event.get('livemode', False))}"
+            login_url = f"{get_frontend_url()}/login"
+            await enqueue_email(
+                "subscription_activation",
+                customer_email or (user_doc.get("email") if 'user_doc' in locals() and user_doc else None),
+                {
+                    "name": (user_doc.get("name") if 'user_doc' in locals() and user_doc else ""),
+                    "login_url": login_url,
+                    "valid_until_iso": valid_until.isoformat() if valid_until else None,
+                    "auto_renew": subscription_auto_renew,
+                },
+                idempotency_key=f"subscription_activation:{event_id}",
             )
         except Exception:
             pass
+    else:
+        update_payload = update_payload_base
+        update_ops = {
+            "$set": update_payload,
+            "$unset": {
+                "subscription_cancelled": "",
+                "subscription_cancel_at_period_end": "",
+            },
+        }
+        if course_ids:
+            update_ops["$addToSet"] = {"enrolled_courses": {"$each": course_ids}}
+        await db.users.update_one({"id": user_id}, update_ops)
+        logger.info(f"Stripe: specific courses granted to user {user_id}: {course_ids}")
+
+    billing_id = data_id or sub_field or data_obj.get("payment_intent")
+    if billing_id:
+        billing_updates = {
+            "status": "paid",
+            "paid_at": ctx.now_iso,
+            "gateway": "stripe",
+        }
+        billing_updates["user_id"] = user_id
+        billing_updates["subscription_plan_id"] = plan_id
+        if customer_id:
+            billing_updates["stripe_customer_id"] = customer_id
+        if amount_cents is not None:
+            try:
+                billing_updates["amount_brl"] = round(float(amount_cents) / 100, 2)
+            except (TypeError, ValueError):
+                pass
+        if currency:
+            billing_updates["currency"] = currency
+
+        await submit_billing(billing_id, billing_updates, {"created_at": ctx.now_iso})
+
+    try:
+        normalized_valid_until = valid_until or (ctx.now + timedelta(days=duration_days) if duration_days > 0 else None)
+        payload = {
+            "source": "stripe",
+            "type": event_type,
+            "status": "checkout_completed" if event_type == "checkout.session.completed" else "payment_succeeded",
+            "user_id": user_id,
+            "subscription_plan_id": plan_id,
+            "subscription_id": subscription_id,
+            "valid_until": (normalized_valid_until.isoformat() if normalized_valid_until else None),
+            "access_scope": access_scope,
+            "course_ids": course_ids,
+            "livemode": livemode,
+            "metadata": meta,
+        }
+        if price_id:
+            payload["price_id"] = price_id
+        _enqueue_status_forward(payload)
         _record_stripe_event({
-            "stage": "verified",
-            "type": event.get("type"),
-            "event_id": event.get("id"),
-            "livemode": bool(event.get("livemode", False)),
-            "payload_json": payload_json,
+            "stage": "processed",
+            "type": event_type,
+            "event_id": event_id,
+            "result": "forwarded_status",
+            "payload_json": ctx.recorded_payload_json,
+            "data_object": ctx.recorded_object(data_obj),
+            "metadata": meta,
         })
-    except ValueError as e:
-        logger.error(f"❌ Invalid payload: {e}")
+    except Exception:
+        pass
+
+    return {"status": "ok"}
+
+
+async def _handle_stripe_subscription_change(event, data_obj: dict, ctx: StripeWebhookContext) -> dict:
+    """customer.subscription.updated/deleted: reflect cancellations and renewals."""
+    event_type = event.get("type")
+    event_id = event.get("id")
+    livemode = bool(event.get("livemode", False))
+    data_id, sub_field, cust_id = data_obj.get("id"), data_obj.get("subscription"), data_obj.get("customer")
+    sub_id = data_id or sub_field
+    status = data_obj.get("status")
+    cancel_at_period_end = bool(data_obj.get("cancel_at_period_end"))
+    current_period_end_ts = data_obj.get("current_period_end")
+    canceled_at_ts = data_obj.get("canceled_at") or data_obj.get("ended_at")
+
+    # If current_period_end isn't present in payload, try retrieving from Stripe
+    # This covers API versions or payloads where the timestamp may be nested/missing
+    try:
+        if not current_period_end_ts and sub_id:
+            sub_probe = await stripe_call_with_retry(stripe.Subscription.retrieve, sub_id)
+            current_period_end_ts = sub_probe.get("current_period_end") or current_period_end_ts
+    except Exception as e:
+        logger.warning(f"Could not derive current_period_end from Stripe: {e}")
+
+    # Resolve customer email
+    email = data_obj.get("customer_email")
+    # Try to resolve user by stored stripe_customer_id first (does not require Stripe API)
+    user_filter = None
+    user_doc = None
+    if cust_id:
         try:
-            replication_manager.audit.error(f"stripe_webhook_invalid_payload error={e}")
+            user_doc = await db.users.find_one({"stripe_customer_id": cust_id}, {"_id": 0, "id": 1, "email": 1})
+            if user_doc and user_doc.get("id"):
+                user_filter = {"id": user_doc["id"]}
+                if not email:
+                    email = user_doc.get("email")
         except Exception:
             pass
-        _record_stripe_event({
-            "stage": "error",
-            "type": "invalid_payload",
-            "error": str(e),
-            "payload_json": payload_json,
-            "payload_raw": payload_text if payload_json is None else None,
-        })
-        raise HTTPException(status_code=400, detail="Invalid payload")
-    except stripe.error.SignatureVerificationError as e:
-        logger.error(f"❌ Invalid signature: {e}")
+    # Fallback to retrieving email from Stripe API if no user found by customer id
+    if not user_filter and not email:
         try:
-            replication_manager.audit.error(f"stripe_webhook_invalid_signature error={e}")
+            if cust_id:
+                cust = await stripe_call_with_retry(stripe.Customer.retrieve, cust_id)
+                email = cust.get("email")
+        except Exception as e:
+            logger.warning(f"Could not retrieve Stripe customer email: {e}")
+    # If still no way to identify the user, ignore
+    if not user_filter and not email:
+        logger.warning("Stripe subscription event without resolvable customer identifier; skipping user update")
+        return {"status": "ignored"}
+
+    # Update user subscription flags and validity
+    lookup_filter = user_filter if user_filter else {"email": email}
+    existing_user = await db.users.find_one(
+        lookup_filter,
+        {
+            "_id": 0,
+            "subscription_plan_id": 1,
+            "subscription_valid_until": 1,
+            "has_full_access": 1,
+            "subscription_status": 1,
+            "subscription_auto_renew": 1,
+            "subscription_cancelled": 1,
+            "subscription_cancel_at_period_end": 1,
+        },
+    )
+
+    auto_renew = None
+    if cancel_at_period_end is not None:
+        auto_renew = not bool(cancel_at_period_end)
+    if status == "canceled" and not cancel_at_period_end:
+        auto_renew = False
+
+    effective_end_ts = None
+    if status == "canceled" and canceled_at_ts and not cancel_at_period_end:
+        effective_end_ts = canceled_at_ts
+    elif current_period_end_ts:
+        effective_end_ts = current_period_end_ts
+    elif canceled_at_ts:
+        effective_end_ts = canceled_at_ts
+
+    valid_until_dt = None
+    if effective_end_ts:
+        try:
+            valid_until_dt = datetime.fromtimestamp(int(effective_end_ts), tz=timezone.utc)
         except Exception:
-            pass
-        _record_stripe_event({
-            "stage": "error",
-            "type": "invalid_signature",
-            "error": str(e),
-            "payload_json": payload_json,
-            "payload_raw": payload_text if payload_json is None else None,
-        })
-        raise HTTPException(status_code=400, detail="Invalid signature")
+            valid_until_dt = None
+    elif existing_user:
+        valid_until_dt = parse_datetime(existing_user.get("subscription_valid_until"))
 
-    # Ensure Stripe SDK is configured with a valid key (covers restarts and DB-provided keys)
-    try:
-        await ensure_stripe_config()
-    except Exception:
-        pass
+    plan_id = (existing_user or {}).get("subscription_plan_id")
+    if not plan_id:
+        price_id = None
+        try:
+            price_id = (((data_obj.get("items") or {}).get("data") or [{}])[0] or {}).get("price", {}).get("id")
+        except Exception:
+            price_id = None
+        if price_id:
+            plan_doc_lookup = await get_plan_by_price_id(price_id)
+            if plan_doc_lookup:
+                plan_id = plan_doc_lookup.get("id")
 
-    event_type = event.get("type")
-    data_obj = (event.get("data", {}) or {}).get("object", {})
-    
-    # Validate payload using Pydantic models
-    try:
-        if event_type == "checkout.session.completed":
-            validated_data = StripeCheckoutSession(**data_obj)
-        elif event_type in ("invoice.payment_succeeded", "invoice.paid"):
-            validated_data = StripeInvoice(**data_obj)
-        else:
-            validated_data = None
-            logger.info(f"Stripe: skipping structured validation for event type: {event_type}")
-    except ValidationError as e:
-        logger.error(f"Stripe payload validation failed: {e}")
+    status_value = determine_subscription_status(plan_id, valid_until_dt, auto_renew)
+
+    updates = {
+        "subscription_status": status_value,
+    }
+    if auto_renew is not None:
+        updates["subscription_auto_renew"] = auto_renew
+    if valid_until_dt:
+        updates["subscription_valid_until"] = valid_until_dt.isoformat()
+    if status == "canceled" and not cancel_at_period_end:
+        updates["has_full_access"] = False
+    if plan_id:
+        updates["subscription_plan_id"] = plan_id
+
+    # Stripe often re-sends updates that change nothing we persist; skip those writes
+    changed = updates
+    if existing_user is not None:
+        changed = {k: v for k, v in updates.items() if existing_user.get(k) != v}
+        if "subscription_cancelled" in existing_user or "subscription_cancel_at_period_end" in existing_user:
+            changed = updates
+    if not changed:
+        logger.debug("stripe sub update no-op for %s", email or lookup_filter)
         _record_stripe_event({
-            "stage": "error",
-            "type": "validation_failed",
-            "error": str(e),
-            "payload_json": data_obj,
+            "stage": "noop",
+            "type": event_type,
+            "event_id": event_id,
+            "subscription_id": sub_id,
         })
-        raise HTTPException(status_code=400, detail="Invalid payload structure")
 
-    # Use validated data if available
-    if validated_data:
-        data_obj = validated_data.model_dump()
+    if changed:
+        # Prefer updating by internal user id if available, otherwise by email
+        update_target = lookup_filter
+        await db.users.update_one(
+            update_target,
+            {
+                "$set": updates,
+                "$unset": {
+                    "subscription_cancelled": "",
+                    "subscription_cancel_at_period_end": "",
+                },
+            },
+        )
+        logger.info(f"Stripe: updated subscription for {(user_doc.get('email') if user_doc else email)} with {updates}")
 
+        # Send cancellation email when applicable
+        try:
+            if status == "canceled" or canceled_at_ts:
+                valid_iso = None
+                try:
+                    if current_period_end_ts:
+                        valid_iso = datetime.fromtimestamp(int(current_period_end_ts), tz=timezone.utc).isoformat()
+                    elif canceled_at_ts:
+                        valid_iso = datetime.fromtimestamp(int(canceled_at_ts), tz=timezone.utc).isoformat()
+                except Exception:
+                    valid_iso = None
+                await enqueue_email(
+                    "subscription_cancellation",
+                    email,
+                    {
+                        "name": (user_doc.get("name") if user_doc else ""),
+                        "valid_until_iso": valid_iso,
+                        "immediate": not cancel_at_period_end,
+                    },
+                    idempotency_key=f"subscription_cancellation:{event_id}",
+                )
+        except Exception:
+            pass
+
+    # Reflect cancellation/update in billings using subscription id
+    if sub_id:
+        await submit_billing(sub_id, {"status": "canceled" if status == "canceled" else status, "updated_at": ctx.now_iso})
+
+    if not changed:
+        return {"status": "ok"}
+
+    # Forward normalized status to external webhook
     try:
-        invoice_success_events = ("invoice.payment_succeeded", "invoice.paid")
-        if event_type in ("checkout.session.completed", *invoice_success_events):
-            meta = data_obj.get("metadata") or {}
-            user_id = meta.get("user_id") or data_obj.get("client_reference_id")
-            plan_id = meta.get("subscription_plan_id")
-            access_scope = meta.get("access_scope") or "full"
-            raw_course_ids = meta.get("course_ids") or ""
-            if isinstance(raw_course_ids, list):
-                course_ids = [str(c) for c in raw_course_ids if c]
-            else:
-                course_ids = [c for c in str(raw_course_ids).split(",") if c]
-            try:
-                duration_days = int(meta.get("duration_days") or 0)
-            except (TypeError, ValueError):
-                duration_days = 0
-            customer_id = data_obj.get("customer")
-            customer_email = data_obj.get("customer_email") or ((data_obj.get("customer_details") or {}).get("email"))
-
-            # Capture monetary information (Stripe reports cents)
-            amount_cents = None
-            currency = None
-            if event_type == "checkout.session.completed":
-                amount_cents = data_obj.get("amount_total") or data_obj.get("amount_subtotal")
-                if data_obj.get("currency"):
-                    currency = data_obj["currency"].upper()
-            else:
-                amount_cents = data_obj.get("amount_paid") or data_obj.get("amount_due")
-                if data_obj.get("currency"):
-                    currency = data_obj["currency"].upper()
+        payload = {
+            "source": "stripe",
+            "type": event_type,
+            "status": "canceled" if event_type == "customer.subscription.deleted" or status == "canceled" else "updated",
+            "customer_email": email,
+            "subscription_id": sub_id,
+            "cancel_at_period_end": bool(cancel_at_period_end),
+            "valid_until": (datetime.fromtimestamp(int(current_period_end_ts), tz=timezone.utc).isoformat() if current_period_end_ts else None),
+            "livemode": livemode,
+        }
+        _enqueue_status_forward(payload)
+        _record_stripe_event({
+            "stage": "processed",
+            "type": event_type,
+            "event_id": event_id,
+            "result": "forwarded_status",
+            "payload_json": ctx.recorded_payload_json,
+            "data_object": ctx.recorded_object(data_obj),
+        })
+    except Exception:
+        pass
 
-            price_id = None
-            sub = None
-            if event_type in invoice_success_events:
-                line_items = ((data_obj.get("lines") or {}).get("data") or [])
-                if line_items:
-                    first_line = line_items[0] or {}
-                    price_data = first_line.get("price") or {}
-                    price_id = price_data.get("id") or price_data.get("price_id")
-                    if not currency:
-                        price_currency = price_data.get("currency")
-                        if price_currency:
-                            currency = price_currency.upper()
-
-            subscription_id = data_obj.get("subscription")
-            if not subscription_id and event_type == "checkout.session.completed":
-                session_id = data_obj.get("id")
-                if session_id:
-                    try:
-                        session_lookup = await stripe_call_with_retry(
-                            stripe.checkout.Session.retrieve,
-                            session_id,
-                            expand=["subscription"],
-                        )
-                        sub_obj = session_lookup.get("subscription")
-                        if sub_obj and isinstance(sub_obj, dict):
-                            subscription_id = sub_obj.get("id")
-                            sub = sub_obj
-                    except Exception as e:
-                        logger.warning(f"Stripe: failed to expand subscription from session {session_id}: {e}")
-            if subscription_id and sub is None:
-                try:
-                    sub = await stripe_call_with_retry(stripe.Subscription.retrieve, subscription_id)
-                except Exception as e:
-                    logger.warning(f"Could not retrieve Stripe subscription {subscription_id}: {e}")
+    return {"status": "ok"}
 
-            if not price_id and sub is not None:
-                try:
-                    sub_items = ((sub or {}).get("items", {}) or {}).get("data", [])
-                    if sub_items:
-                        price_obj = sub_items[0].get("price") or {}
-                        price_id = price_obj.get("id") or price_obj.get("price_id")
-                except Exception:
-                    price_id = price_id
 
-            plan_doc = None
-            if plan_id:
-                plan_doc = await db.subscription_plans.find_one(
-                    {"id": plan_id},
-                    {"_id": 0, "id": 1, "access_scope": 1, "course_ids": 1, "duration_days": 1, "stripe_price_id": 1},
-                )
-            if not plan_doc and price_id:
-                plan_doc = await db.subscription_plans.find_one(
-                    {"stripe_price_id": price_id},
-                    {"_id": 0, "id": 1, "access_scope": 1, "course_ids": 1, "duration_days": 1, "stripe_price_id": 1},
-                )
-                if plan_doc:
-                    plan_id = plan_doc.get("id")
-
-            if plan_doc:
-                access_scope = plan_doc.get("access_scope", access_scope or "full")
-                if access_scope == "specific" and not course_ids:
-                    course_ids = [str(c) for c in plan_doc.get("course_ids", []) if c]
-                if duration_days <= 0:
-                    duration_days = int(plan_doc.get("duration_days", 0) or 0)
-
-            if access_scope != "specific":
-                course_ids = []
-
-            if not user_id and customer_id:
-                user_doc = await db.users.find_one(
-                    {"stripe_customer_id": customer_id},
-                    {"_id": 0, "id": 1, "email": 1, "subscription_plan_id": 1},
-                )
-                if user_doc:
-                    user_id = user_doc.get("id")
-                    if not plan_id:
-                        plan_id = user_doc.get("subscription_plan_id") or plan_id
-                    if not customer_email:
-                        customer_email = user_doc.get("email")
-            if not user_id and customer_email:
-                user_doc = await db.users.find_one(
-                    {"email": customer_email},
-                    {"_id": 0, "id": 1, "subscription_plan_id": 1},
-                )
-                if user_doc:
-                    user_id = user_doc.get("id")
-                    if not plan_id:
-                        plan_id = user_doc.get("subscription_plan_id") or plan_id
-
-            if not user_id or not plan_id:
-                # If we have customer email and a plan, create a new user automatically
-                if customer_email and plan_id:
-                    try:
-                        logger.info(f"Stripe: creating user for {customer_email} from webhook event {event_type}")
-                        new_user_id = str(uuid.uuid4())
-                        # Generate password creation token
-                        password_token = secrets.token_urlsafe(32)
-                        # Try to derive a display name from email
-                        display_name = (customer_email.split("@", 1)[0] or "").replace(".", " ").title()
-                        # Build base user doc
-                        base_user = {
-                            "id": new_user_id,
-                            "email": customer_email,
-                            "name": display_name,
-                            "password": None,
-                            "role": "student",
-                            "avatar": None,
-                            "has_purchased": True,
-                            "created_at": datetime.now(timezone.utc).isoformat(),
-                            "created_via": "stripe",
-                            "password_creation_token": password_token,
-                            "password_token_expires": (datetime.now(timezone.utc) + timedelta(days=7)).isoformat(),
-                            "password_token_history": [password_token],
-                            "stripe_customer_id": customer_id,
-                        }
-                        await db.users.insert_one(base_user)
-                        user_id = new_user_id
-                        # Send password creation email
-                        try:
-                            frontend_url = get_frontend_url()
-                            password_link = f"{frontend_url}/create-password?token={password_token}"
-                            loop = asyncio.get_event_loop()
-                            loop.run_in_executor(
-                                executor,
-                                send_password_creation_email,
-                                customer_email,
-                                display_name,
-                                password_link
-                            )
-                        except Exception as e:
-                            logger.warning(f"Stripe: failed to enqueue password creation email: {e}")
-                    except Exception as e:
-                        logger.warning(f"Stripe: could not create user for {customer_email}: {e}")
-                else:
-                    logger.warning(
-                        f"Stripe webhook missing identifiers after resolution (event={event_type}, customer={customer_id}, email={customer_email}, price_id={price_id})"
-                    )
-                    _record_stripe_event({
-                        "stage": "ignored",
-                        "type": event_type,
-                        "event_id": event.get("id"),
-                        "reason": "missing_identifiers",
-                        "customer_id": customer_id,
-                        "customer_email": customer_email,
-                        "payload_json": payload_json,
-                        "payload_raw": payload_text if payload_json is None else None,
-                    })
-                    return {"status": "ignored"}
+async def _handle_stripe_invoice_payment_failed(event, data_obj: dict, ctx: StripeWebhookContext) -> dict:
+    """invoice.payment_failed: forward the failure and reflect it in billings."""
+    event_type = event.get("type")
+    event_id = event.get("id")
+    livemode = bool(event.get("livemode", False))
+    # Forward failed payment status to external webhook and reflect in billing
+    sub_id, customer_id = data_obj.get("subscription"), data_obj.get("customer")
+    email = None
+    try:
+        if customer_id:
+            cust = await stripe_call_with_retry(stripe.Customer.retrieve, customer_id)
+            email = cust.get("email")
+    except Exception:
+        pass
 
-            # Try to derive validity from Stripe subscription if available
-            valid_until = None
-            if sub is not None:
-                current_period_end = sub.get("current_period_end")
-                if current_period_end:
-                    try:
-                        valid_until = datetime.fromtimestamp(int(current_period_end), tz=timezone.utc)
-                        logger.info(f"Stripe: derived valid_until from subscription {subscription_id}: {valid_until.isoformat()}")
-                    except Exception as e:
-                        logger.warning(f"Stripe: failed to parse current_period_end for {subscription_id}: {e}")
-
-            subscription_auto_renew = None
-            if sub is not None:
-                subscription_auto_renew = not bool(sub.get("cancel_at_period_end"))
-            elif subscription_id:
-                subscription_auto_renew = True
-
-            if not valid_until and duration_days > 0:
-                valid_until = datetime.now(timezone.utc) + timedelta(days=duration_days)
-            status_value = determine_subscription_status(plan_id, valid_until, subscription_auto_renew)
-            update_payload_base = {
-                "has_purchased": True,
-                "subscription_plan_id": plan_id,
-                "subscription_auto_renew": subscription_auto_renew,
-                "subscription_status": status_value,
-                **({"stripe_customer_id": customer_id} if customer_id else {}),
-            }
-            if valid_until:
-                update_payload_base["subscription_valid_until"] = valid_until.isoformat()
+    if sub_id:
+        await submit_billing(sub_id, {"status": "failed", "updated_at": ctx.now_iso})
 
-            if access_scope == "full":
-                update_payload = {
-                    **update_payload_base,
-                    "has_full_access": True,
-                }
-                await db.users.update_one(
-                    {"id": user_id},
-                    {
-                        "$set": update_payload,
-                        "$unset": {
-                            "subscription_cancelled": "",
-                            "subscription_cancel_at_period_end": "",
-                        },
-                    },
-                )
-                logger.info(f"Stripe: full access activated for user {user_id} until {valid_until.isoformat() if valid_until else 'unknown'}")
-                try:
-                    login_url = f"{get_frontend_url()}/login"
-                    loop = asyncio.get_event_loop()
-                    loop.run_in_executor(
-                        executor,
-                        partial(
-                            send_subscription_activation_email,
-                            customer_email or (user_doc.get("email") if 'user_doc' in locals() and user_doc else None),
-                            (user_doc.get("name") if 'user_doc' in locals() and user_doc else ""),
-                            login_url,
-                            valid_until_iso=valid_until.isoformat() if valid_until else None,
-                            auto_renew=subscription_auto_renew,
-                        ),
-                    )
-                except Exception:
-                    pass
-            else:
-                update_payload = update_payload_base
-                update_ops = {
-                    "$set": update_payload,
-                    "$unset": {
-                        "subscription_cancelled": "",
-                        "subscription_cancel_at_period_end": "",
-                    },
-                }
-                if course_ids:
-                    update_ops["$addToSet"] = {"enrolled_courses": {"$each": course_ids}}
-                await db.users.update_one({"id": user_id}, update_ops)
-                logger.info(f"Stripe: specific courses granted to user {user_id}: {course_ids}")
-
-            billing_id = data_obj.get("id") or data_obj.get("subscription") or data_obj.get("payment_intent")
-            if billing_id:
-                billing_updates = {
-                    "status": "paid",
-                    "paid_at": datetime.now(timezone.utc).isoformat(),
-                    "gateway": "stripe",
-                }
-                billing_updates["user_id"] = user_id
-                billing_updates["subscription_plan_id"] = plan_id
-                if customer_id:
-                    billing_updates["stripe_customer_id"] = customer_id
-                if amount_cents is not None:
-                    try:
-                        billing_updates["amount_brl"] = round(float(amount_cents) / 100, 2)
-                    except (TypeError, ValueError):
-                        pass
-                if currency:
-                    billing_updates["currency"] = currency
-
-                await db.billings.update_one(
-                    {"billing_id": billing_id},
-                    {
-                        "$set": billing_updates,
-                        "$setOnInsert": {"created_at": datetime.now(timezone.utc).isoformat()},
-                    },
-                    upsert=True,
-                )
+    try:
+        payload = {
+            "source": "stripe",
+            "type": event_type,
+            "status": "payment_failed",
+            "customer_email": email,
+            "subscription_id": sub_id,
+            "livemode": livemode,
+        }
+        _enqueue_status_forward(payload)
+        _record_stripe_event({
+            "stage": "processed",
+            "type": event_type,
+            "event_id": event_id,
+            "result": "forwarded_status",
+            "payload_json": ctx.recorded_payload_json,
+            "data_object": ctx.recorded_object(data_obj),
+        })
+    except Exception:
+        pass
 
-            try:
-                normalized_valid_until = valid_until or (datetime.now(timezone.utc) + timedelta(days=duration_days) if duration_days > 0 else None)
-                payload = {
-                    "source": "stripe",
-                    "type": event_type,
-                    "status": "checkout_completed" if event_type == "checkout.session.completed" else "payment_succeeded",
-                    "user_id": user_id,
-                    "subscription_plan_id": plan_id,
-                    "subscription_id": subscription_id or data_obj.get("subscription"),
-                    "valid_until": (normalized_valid_until.isoformat() if normalized_valid_until else None),
-                    "access_scope": access_scope,
-                    "course_ids": course_ids,
-                    "livemode": bool(event.get("livemode", False)),
-                    "metadata": meta,
-                }
-                if price_id:
-                    payload["price_id"] = price_id
-                await _forward_status_to_client(payload)
-                _record_stripe_event({
-                    "stage": "processed",
-                    "type": event_type,
-                    "event_id": event.get("id"),
-                    "result": "forwarded_status",
-                    "payload_json": payload_json,
-                    "data_object": data_obj,
-                    "metadata": meta,
-                })
-            except Exception:
-                pass
+    return {"status": "ok"}
 
-        # Handle subscription lifecycle events to reflect cancellations/updates
-        elif event_type in ("customer.subscription.updated", "customer.subscription.deleted"):
-            status = data_obj.get("status")
-            cancel_at_period_end = bool(data_obj.get("cancel_at_period_end"))
-            current_period_end_ts = data_obj.get("current_period_end")
-            canceled_at_ts = data_obj.get("canceled_at") or data_obj.get("ended_at")
 
-            # If current_period_end isn't present in payload, try retrieving from Stripe
-            # This covers API versions or payloads where the timestamp may be nested/missing
-            try:
-                if not current_period_end_ts:
-                    sub_id_probe = data_obj.get("id") or data_obj.get("subscription")
-                    if sub_id_probe:
-                        sub_probe = await stripe_call_with_retry(stripe.Subscription.retrieve, sub_id_probe)
-                        current_period_end_ts = sub_probe.get("current_period_end") or current_period_end_ts
-            except Exception as e:
-                logger.warning(f"Could not derive current_period_end from Stripe: {e}")
-
-            # Resolve customer email
-            email = data_obj.get("customer_email")
-            cust_id = data_obj.get("customer")
-            # Try to resolve user by stored stripe_customer_id first (does not require Stripe API)
-            user_filter = None
-            user_doc = None
-            if cust_id:
-                try:
-                    user_doc = await db.users.find_one({"stripe_customer_id": cust_id}, {"_id": 0, "id": 1, "email": 1})
-                    if user_doc and user_doc.get("id"):
-                        user_filter = {"id": user_doc["id"]}
-                        if not email:
-                            email = user_doc.get("email")
-                except Exception:
-                    pass
-            # Fallback to retrieving email from Stripe API if no user found by customer id
-            if not user_filter and not email:
-                try:
-                    if cust_id:
-                        cust = await stripe_call_with_retry(stripe.Customer.retrieve, cust_id)
-                        email = cust.get("email")
-                except Exception as e:
-                    logger.warning(f"Could not retrieve Stripe customer email: {e}")
-            # If still no way to identify the user, ignore
-            if not user_filter and not email:
-                logger.warning("Stripe subscription event without resolvable customer identifier; skipping user update")
-                return {"status": "ignored"}
-
-            # Update user subscription flags and validity
-            lookup_filter = user_filter if user_filter else {"email": email}
-            existing_user = await db.users.find_one(
-                lookup_filter,
-                {"_id": 0, "subscription_plan_id": 1, "subscription_valid_until": 1, "has_full_access": 1},
-            )
+async def _handle_stripe_unhandled_event(event, data_obj: dict, ctx: StripeWebhookContext) -> dict:
+    logger.info(f"Stripe: no handler for event type {event.get('type')}")
+    return {"status": "ok"}
 
-            auto_renew = None
-            if cancel_at_period_end is not None:
-                auto_renew = not bool(cancel_at_period_end)
-            if status == "canceled" and not cancel_at_period_end:
-                auto_renew = False
 
-            effective_end_ts = None
-            if status == "canceled" and canceled_at_ts and not cancel_at_period_end:
-                effective_end_ts = canceled_at_ts
-            elif current_period_end_ts:
-                effective_end_ts = current_period_end_ts
-            elif canceled_at_ts:
-                effective_end_ts = canceled_at_ts
+STRIPE_EVENT_HANDLERS = {
+    "checkout.session.completed": _handle_stripe_payment_succeeded,
+    "invoice.payment_succeeded": _handle_stripe_payment_succeeded,
+    "invoice.paid": _handle_stripe_payment_succeeded,
+    "customer.subscription.updated": _handle_stripe_subscription_change,
+    "customer.subscription.deleted": _handle_stripe_subscription_change,
+    "invoice.payment_failed": _handle_stripe_invoice_payment_failed,
+}
 
-            valid_until_dt = None
-            if effective_end_ts:
-                try:
-                    valid_until_dt = datetime.fromtimestamp(int(effective_end_ts), tz=timezone.utc)
-                except Exception:
-                    valid_until_dt = None
-            elif existing_user:
-                valid_until_dt = parse_datetime(existing_user.get("subscription_valid_until"))
 
-            plan_id = (existing_user or {}).get("subscription_plan_id")
-            if not plan_id:
-                price_id = None
-                try:
-                    price_id = (((data_obj.get("items") or {}).get("data") or [{}])[0] or {}).get("price", {}).get("id")
-                except Exception:
-                    price_id = None
-                if price_id:
-                    plan_doc_lookup = await db.subscription_plans.find_one(
-                        {"stripe_price_id": price_id},
-                        {"_id": 0, "id": 1},
-                    )
-                    if plan_doc_lookup:
-                        plan_id = plan_doc_lookup.get("id")
+@api_router.post("/webhook/stripe")
+async def stripe_webhook(request: Request):
+    logger.info("🔔 Received Stripe webhook request")
+    
+    webhook_secret = os.environ.get('STRIPE_WEBHOOK_SECRET') or STRIPE_WEBHOOK_SECRET
+    if not webhook_secret:
+        # Try reading from payment_settings in DB as a fallback
+        try:
+            settings = await db.payment_settings.find_one({}, {"_id": 0})
+            if settings and settings.get("stripe_webhook_secret"):
+                webhook_secret = settings["stripe_webhook_secret"]
+                os.environ['STRIPE_WEBHOOK_SECRET'] = webhook_secret
+        except Exception:
+            pass
+    if not webhook_secret:
+        logger.error("Stripe webhook secret not configured")
+        raise HTTPException(status_code=500, detail="Stripe webhook not configured")
 
-            status_value = determine_subscription_status(plan_id, valid_until_dt, auto_renew)
+    payload = await request.body()
+    payload_text = ""
+    payload_json = None
+    if payload:
+        try:
+            payload_text = payload.decode("utf-8")
+        except Exception:
+            payload_text = payload.decode("utf-8", errors="replace")
+        try:
+            payload_json = _json_loads(payload)
+        except Exception:
+            payload_json = None
+    sig_header = request.headers.get("Stripe-Signature")
 
-            updates = {
-                "subscription_status": status_value,
-            }
-            if auto_renew is not None:
-                updates["subscription_auto_renew"] = auto_renew
-            if valid_until_dt:
-                updates["subscription_valid_until"] = valid_until_dt.isoformat()
-            if status == "canceled" and not cancel_at_period_end:
-                updates["has_full_access"] = False
-            if plan_id:
-                updates["subscription_plan_id"] = plan_id
-
-            if updates:
-                # Prefer updating by internal user id if available, otherwise by email
-                update_target = lookup_filter
-                await db.users.update_one(
-                    update_target,
-                    {
-                        "$set": updates,
-                        "$unset": {
-                            "subscription_cancelled": "",
-                            "subscription_cancel_at_period_end": "",
-                        },
-                    },
-                )
-                logger.info(f"Stripe: updated subscription for {(user_doc.get('email') if user_doc else email)} with {updates}")
+    # Keep the monitoring buffer bounded: large payloads are stored as a summary
+    keep_full_payload = STRIPE_WEBHOOK_DEBUG_PAYLOADS or len(payload) <= STRIPE_EVENT_MAX_RECORDED_PAYLOAD_BYTES
+    if keep_full_payload:
+        recorded_payload_json = payload_json
+        recorded_payload_raw = payload_text if payload_json is None else None
+    else:
+        recorded_payload_json = _summarize_stripe_payload(payload, payload_json)
+        recorded_payload_raw = None
 
-                # Send cancellation email when applicable
-                try:
-                    if status == "canceled" or canceled_at_ts:
-                        valid_iso = None
-                        try:
-                            if current_period_end_ts:
-                                valid_iso = datetime.fromtimestamp(int(current_period_end_ts), tz=timezone.utc).isoformat()
-                            elif canceled_at_ts:
-                                valid_iso = datetime.fromtimestamp(int(canceled_at_ts), tz=timezone.utc).isoformat()
-                        except Exception:
-                            valid_iso = None
-                        loop = asyncio.get_event_loop()
-                        loop.run_in_executor(
-                            executor,
-                            partial(
-                                send_subscription_cancellation_email,
-                                email,
-                                (user_doc.get("name") if user_doc else ""),
-                                valid_iso,
-                                immediate=not cancel_at_period_end,
-                            ),
-                        )
-                except Exception:
-                    pass
+    logger.info(f"📝 Webhook payload size: {len(payload)} bytes")
+    logger.info(f"🔐 Signature header present: {bool(sig_header)}")
+    logger.info(f"🔑 Using webhook secret: {webhook_secret[:10]}...")
+    try:
+        replication_manager.audit.info(
+            f"stripe_webhook_received size={len(payload)} signature_present={bool(sig_header)}"
+        )
+    except Exception:
+        pass
+    _record_stripe_event({
+        "stage": "received",
+        "type": "unknown",
+        "payload_size": len(payload),
+        "signature_present": bool(sig_header),
+        "payload_json": recorded_payload_json,
+        "payload_raw": recorded_payload_raw,
+    })
 
-            # Reflect cancellation/update in billings using subscription id
-            sub_id = data_obj.get("id") or data_obj.get("subscription")
-            if sub_id:
-                await db.billings.update_one(
-                    {"billing_id": sub_id},
-                    {"$set": {"status": "canceled" if status == "canceled" else status, "updated_at": datetime.now(timezone.utc).isoformat()}},
-                    upsert=True,
-                )
+    try:
+        event = await stripe_call_with_retry(
+            stripe.Webhook.construct_event,
+            payload=payload,
+            sig_header=sig_header,
+            secret=webhook_secret,
+        )
+        logger.info(f"✅ Webhook signature verified successfully")
+        try:
+            replication_manager.audit.info(
+                f"stripe_webhook_verified type={event.get('type')} id={event.get('id')} livemode={bool(event.get('livemode', False))}"
+            )
+        except Exception:
+            pass
+        _record_stripe_event({
+            "stage": "verified",
+            "type": event.get("type"),
+            "event_id": event.get("id"),
+            "livemode": bool(event.get("livemode", False)),
+            "payload_json": recorded_payload_json,
+        })
+    except ValueError as e:
+        logger.error(f"❌ Invalid payload: {e}")
+        try:
+            replication_manager.audit.error(f"stripe_webhook_invalid_payload error={e}")
+        except Exception:
+            pass
+        _record_stripe_event({
+            "stage": "error",
+            "type": "invalid_payload",
+            "error": str(e),
+            "payload_json": recorded_payload_json,
+            "payload_raw": recorded_payload_raw,
+        })
+        raise HTTPException(status_code=400, detail="Invalid payload")
+    except stripe.error.SignatureVerificationError as e:
+        logger.error(f"❌ Invalid signature: {e}")
+        try:
+            replication_manager.audit.error(f"stripe_webhook_invalid_signature error={e}")
+        except Exception:
+            pass
+        _record_stripe_event({
+            "stage": "error",
+            "type": "invalid_signature",
+            "error": str(e),
+            "payload_json": recorded_payload_json,
+            "payload_raw": recorded_payload_raw,
+        })
+        raise HTTPException(status_code=400, detail="Invalid signature")
 
-            # Forward normalized status to external webhook
-            try:
-                payload = {
-                    "source": "stripe",
-                    "type": event_type,
-                    "status": "canceled" if event_type == "customer.subscription.deleted" or status == "canceled" else "updated",
-                    "customer_email": email,
-                    "subscription_id": sub_id,
-                    "cancel_at_period_end": bool(cancel_at_period_end),
-                    "valid_until": (datetime.fromtimestamp(int(current_period_end_ts), tz=timezone.utc).isoformat() if current_period_end_ts else None),
-                    "livemode": bool(event.get("livemode", False))
-                }
-                await _forward_status_to_client(payload)
-                _record_stripe_event({
-                    "stage": "processed",
-                    "type": event_type,
-                    "event_id": event.get("id"),
-                    "result": "forwarded_status",
-                    "payload_json": payload_json,
-                    "data_object": data_obj,
-                })
-            except Exception:
-                pass
+    event_type = event.get("type")
+    event_id = event.get("id")
+    data_obj = (event.get("data", {}) or {}).get("object", {})
+    # Single timestamp for the whole event keeps every write consistent
+    ctx = StripeWebhookContext(
+        now=datetime.now(timezone.utc),
+        recorded_payload_json=recorded_payload_json,
+        recorded_payload_raw=recorded_payload_raw,
+        keep_full_payload=keep_full_payload,
+    )
 
-        elif event_type == "invoice.payment_failed":
-            # Forward failed payment status to external webhook and reflect in billing
-            sub_id = data_obj.get("subscription")
-            customer_id = data_obj.get("customer")
-            email = None
-            try:
-                if customer_id:
-                    cust = await stripe_call_with_retry(stripe.Customer.retrieve, customer_id)
-                    email = cust.get("email")
-            except Exception:
-                pass
+    if event_id in _processed_stripe_event_ids:
+        logger.info(f"Stripe: event {event_id} already processed; skipping redelivery")
+        _record_stripe_event({
+            "stage": "ignored",
+            "type": event_type,
+            "event_id": event_id,
+            "reason": "duplicate_delivery",
+        })
+        return {"status": "duplicate"}
 
-            if sub_id:
-                await db.billings.update_one(
-                    {"billing_id": sub_id},
-                    {"$set": {"status": "failed", "updated_at": datetime.now(timezone.utc).isoformat()}},
-                    upsert=True,
-                )
+    handler = STRIPE_EVENT_HANDLERS.get(event_type, _handle_stripe_unhandled_event)
+    if handler is not _handle_stripe_unhandled_event:
+        # Ensure Stripe SDK is configured with a valid key (covers restarts and DB-provided keys)
+        try:
+            await ensure_stripe_config()
+        except Exception:
+            pass
 
+    # Validate payload using Pydantic models
+    model = STRIPE_EVENT_MODELS.get(event_type)
+    if model is not None:
         try:
-            payload = {
-                "source": "stripe",
-                "type": event_type,
-                "status": "payment_failed",
-                "customer_email": email,
-                "subscription_id": sub_id,
-                "livemode": bool(event.get("livemode", False))
-            }
-            await _forward_status_to_client(payload)
+            data_obj = model(**data_obj).model_dump()
+        except ValidationError as e:
+            logger.error(f"Stripe payload validation failed: {e}")
             _record_stripe_event({
-                "stage": "processed",
-                "type": event_type,
-                "event_id": event.get("id"),
-                "result": "forwarded_status",
-                "payload_json": payload_json,
-                "data_object": data_obj,
+                "stage": "error",
+                "type": "validation_failed",
+                "error": str(e),
+                "payload_json": ctx.recorded_object(data_obj),
             })
-        except Exception:
-            pass
+            raise HTTPException(status_code=400, detail="Invalid payload structure")
+    else:
+        logger.info(f"Stripe: skipping structured validation for event type: {event_type}")
 
-        return {"status": "ok"}
+    try:
+        result = await handler(event, data_obj, ctx)
+        _mark_stripe_event_processed(event_id)
+        return result
     except Exception as e:
         logger.error(f"Error processing Stripe webhook: {e}", exc_info=True)
         try:
@@ -7251,10 +7662,10 @@ async def stripe_webhook(request: Request):
             _record_stripe_event({
                 "stage": "error",
                 "type": event_type or "unknown",
-                "event_id": (event or {}).get("id") if isinstance(event, dict) else None,
+                "event_id": event_id,
                 "error": str(e),
-                "payload_json": payload_json,
-                "payload_raw": payload_text if payload_json is None else None,
+                "payload_json": recorded_payload_json,
+                "payload_raw": recorded_payload_raw,
             })
         except Exception:
             pass
@@ -7264,67 +7675,116 @@ async def stripe_webhook(request: Request):
 async def list_stripe_webhook_events(current_user: User = Depends(get_current_admin)):
     """Lista os últimos eventos de webhook do Stripe registrados em memória (admin only)"""
     try:
-        events = list(reversed(list(STRIPE_WEBHOOK_EVENTS_BUFFER)))
-        return {"events": events[:100]}
+        events = list(islice(reversed(STRIPE_WEBHOOK_EVENTS_BUFFER), 100))
+        return {"events": events}
     except Exception as e:
         logger.error(f"Failed to list Stripe webhook events: {e}")
         raise HTTPException(status_code=500, detail="Failed to list webhook events")
 
-# Hotmart Webhook Endpoint
-# Helper function to send password creation email
-def send_password_creation_email(email: str, name: str, password_link: str):
-    """Send password creation email to new user via SMTP"""
+# email_config is read on every send but almost never changes: keep it in a
+# process-wide TTL cache instead of opening a Mongo connection per email.
+EMAIL_CONFIG_TTL_SECONDS = 60.0
+_email_config_cache: Dict[str, Any] = {"value": None, "expires": 0.0}
+
+
+def _store_email_config(config: Optional[dict]) -> None:
+    _email_config_cache["value"] = config
+    _email_config_cache["expires"] = time.monotonic() + EMAIL_CONFIG_TTL_SECONDS
+
+
+def invalidate_email_config_cache() -> None:
+    _email_config_cache["expires"] = 0.0
+
+
+async def _get_email_config_async() -> Optional[dict]:
+    if time.monotonic() < _email_config_cache["expires"]:
+        return _email_config_cache["value"]
     try:
-        import smtplib
-        from email.mime.text import MIMEText
-        from email.mime.multipart import MIMEMultipart
-        
-        # Get Brevo configuration synchronously
-        from pymongo import MongoClient
-        mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-        sync_client = MongoClient(mongo_url)
-        sync_db = sync_client[os.environ.get('DB_NAME', 'hiperautomacao_db')]
-        
-        config = sync_db.email_config.find_one({})
-        
+        config = await db.email_config.find_one({}, {"_id": 0})
+    except Exception as exc:
+        logger.warning("Could not refresh email config: %s", exc)
+        return _email_config_cache["value"]
+    _store_email_config(config)
+    return config
+
+
+# One pooled connection per concurrent email send is enough to never block on the pool
+smtp_pool = SMTPPool(max_per_key=EMAIL_SEND_CONCURRENCY)
+async_smtp_pool = AsyncSMTPPool()
+
+
+def _smtp_settings_from_config(config: dict) -> Dict[str, Any]:
+    """Resolve sender and SMTP credentials from an email_config document."""
+    # Priority: smtp_username/password, fallback to old method
+    smtp_username = config.get('smtp_username')
+    smtp_password = config.get('smtp_password')
+    if not smtp_username or not smtp_password:
+        smtp_username = config.get('sender_email')
+        smtp_password = config.get('brevo_smtp_key') or config.get('brevo_api_key')
+    return {
+        "sender_email": config.get('sender_email'),
+        "sender_name": config.get('sender_name', 'Hiperautomação'),
+        "smtp_username": smtp_username,
+        "smtp_password": smtp_password,
+        "smtp_server": config.get('smtp_server', 'smtp-relay.brevo.com'),
+        "smtp_port": config.get('smtp_port', 587),
+    }
+
+
+def _compose_html_email(settings: Dict[str, Any], to_email: str, subject: str, html_content: str):
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = subject
+    msg['From'] = f"{settings['sender_name']} <{settings['sender_email']}>"
+    msg['To'] = to_email
+    msg.attach(MIMEText(html_content, 'html'))
+    return msg
+
+
+async def _send_html_email_async(kind: str, to_email: str, subject: str, html_content: str) -> bool:
+    """Send an HTML email over a pooled aiosmtplib connection on the event loop."""
+    try:
+        config = await _get_email_config_async()
         if not config:
-            logger.warning("No email configuration found, skipping welcome email")
-            sync_client.close()
-            return
-        
-        sender_email = config.get('sender_email')
-        sender_name = config.get('sender_name', 'Hiperautomação')
-        
-        # Get SMTP credentials (priority: smtp_username/password, fallback to old method)
-        smtp_username = config.get('smtp_username')
-        smtp_password = config.get('smtp_password')
-        smtp_server = config.get('smtp_server', 'smtp-relay.brevo.com')
-        smtp_port = config.get('smtp_port', 587)
-        
-        # Fallback to old method if new fields not set
-        if not smtp_username or not smtp_password:
-            smtp_username = config.get('sender_email')
-            smtp_password = config.get('brevo_smtp_key') or config.get('brevo_api_key')
-        
-        if not smtp_username or not smtp_password:
+            logger.warning(f"No email configuration found, skipping {kind} email")
+            return False
+
+        settings = _smtp_settings_from_config(config)
+        if not settings["smtp_username"] or not settings["smtp_password"]:
             logger.error("No SMTP credentials found in configuration")
-            sync_client.close()
-            return
-        
-        # Create message
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = 'Bem-vindo! Crie sua senha - Hiperautomação'
-        msg['From'] = f"{sender_name} <{sender_email}>"
-        msg['To'] = email
-        
-        html_content = f"""
+            return False
+
+        msg = _compose_html_email(settings, to_email, subject, html_content)
+        await async_smtp_pool.send_message(
+            settings["smtp_server"],
+            settings["smtp_port"],
+            settings["smtp_username"],
+            settings["smtp_password"],
+            msg,
+        )
+        logger.info(f"✅ {kind.capitalize()} email sent successfully to {to_email} via SMTP")
+        return True
+    except Exception as e:
+        logger.error(f"❌ Failed to send {kind} email to {to_email}: {e}")
+        return False
+
+
+# Email bodies are compiled once at import; autoescape keeps user-provided names
+# (often derived from the email address) from injecting markup.
+_email_templates = jinja2.Environment(autoescape=True)
+
+PASSWORD_CREATION_EMAIL_SUBJECT = 'Bem-vindo! Crie sua senha - Hiperautomação'
+
+_PASSWORD_CREATION_TPL = _email_templates.from_string("""
         <html>
         <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
             <h2 style="color: #10b981;">Bem-vindo à Hiperautomação! 🎉</h2>
-            <p>Olá {name},</p>
+            <p>Olá {{ name }},</p>
             <p>Sua compra foi confirmada com sucesso! Agora você precisa criar sua senha para acessar a plataforma.</p>
             <p style="margin: 30px 0;">
-                <a href="{password_link}" 
+                <a href="{{ password_link }}" 
                    style="background-color: #10b981; color: white; padding: 12px 30px; 
                           text-decoration: none; border-radius: 5px; display: inline-block;">
                     Criar Minha Senha
@@ -7338,23 +7798,74 @@ def send_password_creation_email(email: str, name: str, password_link: str):
             </p>
         </body>
         </html>
-        """
-        
-        part = MIMEText(html_content, 'html')
-        msg.attach(part)
-        
-        # Send via SMTP
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_username, smtp_password)
-            server.send_message(msg)
-        
-        logger.info(f"✅ Welcome email sent successfully to {email} via SMTP")
-        sync_client.close()
-        
-    except Exception as e:
-        logger.error(f"❌ Failed to send welcome email to {email}: {e}")
-        logger.error(f"Exception type: {type(e).__name__}")
+        """)
+
+
+def _build_password_creation_html(name: str, password_link: str) -> str:
+    return _PASSWORD_CREATION_TPL.render(name=name, password_link=password_link)
+
+
+# Hotmart Webhook Endpoint
+# Helper function to send password creation email
+async def send_password_creation_email_async(email: str, name: str, password_link: str) -> bool:
+    """Send password creation email via SMTP without blocking the event loop"""
+    return await _send_html_email_async(
+        "welcome",
+        email,
+        PASSWORD_CREATION_EMAIL_SUBJECT,
+        _build_password_creation_html(name, password_link),
+    )
+
+def _invite_token_refresh_update(new_token: str, now: datetime) -> dict:
+    """Update document rotating an invitation token (valid for 7 days)."""
+    return {
+        "$set": {
+            "token": new_token,
+            "updated_at": now.isoformat(),
+            "expires_at": (now + _TOKEN_TTL).isoformat(),
+        },
+        "$addToSet": {"token_history": new_token},
+    }
+
+
+def _user_token_refresh_update(user: dict, new_token: str, now: datetime, clear_password: bool = False) -> dict:
+    """Update document issuing a new password creation token for a user, keeping token history."""
+    previous_token = user.get("password_creation_token")
+    history_each = [new_token] + ([previous_token] if previous_token else [])
+    set_fields = {
+        "password_creation_token": new_token,
+        "password_token_expires": (now + _TOKEN_TTL).isoformat(),
+        "updated_at": now.isoformat(),
+    }
+    if clear_password:
+        set_fields["password"] = None
+    return {
+        "$set": set_fields,
+        "$addToSet": {"password_token_history": {"$each": history_each}},
+    }
+
+
+def _user_token_refresh_pipeline(new_token: str, now: datetime, clear_password: bool = False) -> list:
+    """Pipeline form of _user_token_refresh_update for when the user document has not been read yet.
+
+    The previous token is taken from the stored document, so the history union happens server-side.
+    """
+    set_fields = {
+        "password_creation_token": new_token,
+        "password_token_expires": (now + _TOKEN_TTL).isoformat(),
+        "updated_at": now.isoformat(),
+        "password_token_history": {
+            "$setUnion": [
+                {"$ifNull": ["$password_token_history", []]},
+                [new_token],
+                {"$cond": [{"$ifNull": ["$password_creation_token", False]}, ["$password_creation_token"], []]},
+            ]
+        },
+    }
+    if clear_password:
+        set_fields["password"] = None
+    return [{"$set": set_fields}]
+
 
 # Resend password creation email
 @api_router.post("/admin/users/{user_id}/resend-password-email")
@@ -7366,35 +7877,19 @@ async def resend_password_email(user_id: str, current_user: User = Depends(get_c
             raise HTTPException(status_code=404, detail="Invitation not found")
 
         new_token = secrets.token_urlsafe(32)
-        now = datetime.now(timezone.utc)
-        now_iso = now.isoformat()
-        expires_at = (now + timedelta(days=7)).isoformat()
-        combined_history = [new_token] + invite_doc.get("token_history", [])
-
         await db.password_tokens.update_one(
             {"token": invite_doc["token"]},
-            {
-                "$set": {
-                    "token": new_token,
-                    "updated_at": now_iso,
-                    "expires_at": expires_at,
-                    "token_history": list(dict.fromkeys(combined_history)),
-                }
-            },
+            _invite_token_refresh_update(new_token, datetime.now(timezone.utc)),
         )
 
         frontend_url = get_frontend_url()
         password_link = f"{frontend_url}/create-password?token={new_token}"
 
-        loop = asyncio.get_event_loop()
-        loop.run_in_executor(
-            executor,
-            partial(
-                send_password_creation_email,
-                invite_doc["email"],
-                invite_doc.get("name") or invite_doc["email"],
-                password_link,
-            ),
+        await enqueue_email(
+            "password_creation",
+            invite_doc["email"],
+            {"name": invite_doc.get("name") or invite_doc["email"], "password_link": password_link},
+            idempotency_key=f"password_creation:{new_token}",
         )
 
         logger.info(
@@ -7410,26 +7905,12 @@ async def resend_password_email(user_id: str, current_user: User = Depends(get_c
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Generate new token
+    # Generate new token and update user, tracking history
     password_token = secrets.token_urlsafe(32)
-    now_iso = datetime.now(timezone.utc).isoformat()
-    previous_token = user.get("password_creation_token")
-
-    # Update user with new token and track history
-    update_doc = {
-        "$set": {
-            "password_creation_token": password_token,
-            "password_token_expires": (datetime.now(timezone.utc) + timedelta(days=7)).isoformat(),
-            "updated_at": now_iso,
-        },
-        "$addToSet": {
-            "password_token_history": {"$each": [password_token]},
-        },
-    }
-    if previous_token:
-        update_doc["$addToSet"]["password_token_history"]["$each"].append(previous_token)
-
-    await db.users.update_one({"id": user_id}, update_doc)
+    await db.users.update_one(
+        {"id": user_id},
+        _user_token_refresh_update(user, password_token, datetime.now(timezone.utc)),
+    )
     
     # Send email
     try:
@@ -7437,13 +7918,11 @@ async def resend_password_email(user_id: str, current_user: User = Depends(get_c
         password_link = f"{frontend_url}/create-password?token={password_token}"
         
         # Send email in background
-        loop = asyncio.get_event_loop()
-        loop.run_in_executor(
-            executor,
-            send_password_creation_email,
+        await enqueue_email(
+            "password_creation",
             user["email"],
-            user["name"],
-            password_link
+            {"name": user["name"], "password_link": password_link},
+            idempotency_key=f"password_creation:{password_token}",
         )
         
         logger.info(f"📧 Password creation email resent to {user['email']} by admin {current_user.email}")
@@ -7453,6 +7932,79 @@ async def resend_password_email(user_id: str, current_user: User = Depends(get_c
         logger.error(f"Failed to send email: {e}")
         raise HTTPException(status_code=500, detail="Erro ao enviar email")
 
+# Resend password creation emails for several users/invites at once
+@api_router.post("/admin/users/bulk-resend-invite")
+async def bulk_resend_password_email(request: BulkResendInviteRequest, current_user: User = Depends(get_current_admin)):
+    """Rotate tokens for many users/invites with one bulk write per collection and queue the emails"""
+    user_ids = list(dict.fromkeys(request.user_ids))
+    invite_tokens = [extract_token_from_invite_id(uid) for uid in user_ids if is_invite_id(uid)]
+    real_user_ids = [uid for uid in user_ids if not is_invite_id(uid)]
+
+    now = datetime.now(timezone.utc)
+    frontend_url = get_frontend_url()
+    password_token_ops = []
+    user_ops = []
+    recipients = []
+    found_ids = set()
+
+    if invite_tokens:
+        async for invite_doc in db.password_tokens.find({"token": {"$in": invite_tokens}}):
+            new_token = secrets.token_urlsafe(32)
+            password_token_ops.append(
+                UpdateOne({"token": invite_doc["token"]}, _invite_token_refresh_update(new_token, now))
+            )
+            found_ids.add(f"{INVITE_ID_PREFIX}{invite_doc['token']}")
+            recipients.append((
+                invite_doc["email"],
+                invite_doc.get("name") or invite_doc["email"],
+                new_token,
+                f"{frontend_url}/create-password?token={new_token}",
+            ))
+
+    if real_user_ids:
+        async for user in db.users.find(
+            {"id": {"$in": real_user_ids}},
+            {"_id": 0, "id": 1, "email": 1, "name": 1, "password_creation_token": 1},
+        ):
+            new_token = secrets.token_urlsafe(32)
+            user_ops.append(UpdateOne({"id": user["id"]}, _user_token_refresh_update(user, new_token, now)))
+            found_ids.add(user["id"])
+            recipients.append((
+                user["email"],
+                user.get("name") or user["email"],
+                new_token,
+                f"{frontend_url}/create-password?token={new_token}",
+            ))
+
+    if password_token_ops:
+        await db.password_tokens.bulk_write(password_token_ops, ordered=False)
+    if user_ops:
+        await db.users.bulk_write(user_ops, ordered=False)
+
+    # Tokens are stored before queueing so no email can point at a token that was never saved;
+    # the outbox drainer paces delivery and retries failures.
+    for email, name, token, link in recipients:
+        await enqueue_email(
+            "password_creation",
+            email,
+            {"name": name, "password_link": link},
+            idempotency_key=f"password_creation:{token}",
+        )
+    queued = len(recipients)
+    not_found = [uid for uid in user_ids if uid not in found_ids]
+
+    logger.info(
+        "📧 Bulk resend of password emails by %s: %s queued, %s not found",
+        current_user.email,
+        queued,
+        len(not_found),
+    )
+    return {
+        "message": f"{queued} email(s) na fila de envio",
+        "queued": queued,
+        "not_found": not_found,
+    }
+
 # Reset user password (admin)
 @api_router.post("/admin/users/{user_id}/reset-password")
 async def reset_user_password(user_id: str, current_user: User = Depends(get_current_admin)):
@@ -7462,34 +8014,18 @@ async def reset_user_password(user_id: str, current_user: User = Depends(get_cur
         if not invite_doc:
             raise HTTPException(status_code=404, detail="Invitation not found")
         new_token = secrets.token_urlsafe(32)
-        now = datetime.now(timezone.utc)
-        now_iso = now.isoformat()
-        expires_at = (now + timedelta(days=7)).isoformat()
-        combined_history = [new_token] + invite_doc.get("token_history", [])
-
         await db.password_tokens.update_one(
             {"token": invite_doc["token"]},
-            {
-                "$set": {
-                    "token": new_token,
-                    "expires_at": expires_at,
-                    "updated_at": now_iso,
-                    "token_history": list(dict.fromkeys(combined_history)),
-                }
-            },
+            _invite_token_refresh_update(new_token, datetime.now(timezone.utc)),
         )
 
         frontend_url = get_frontend_url()
         password_link = f"{frontend_url}/create-password?token={new_token}"
-        loop = asyncio.get_event_loop()
-        loop.run_in_executor(
-            executor,
-            partial(
-                send_password_creation_email,
-                invite_doc["email"],
-                invite_doc.get("name") or invite_doc["email"],
-                password_link,
-            ),
+        await enqueue_email(
+            "password_creation",
+            invite_doc["email"],
+            {"name": invite_doc.get("name") or invite_doc["email"], "password_link": password_link},
+            idempotency_key=f"password_creation:{new_token}",
         )
 
         logger.info(
@@ -7499,46 +8035,29 @@ async def reset_user_password(user_id: str, current_user: User = Depends(get_cur
         )
         return {"message": "Convite atualizado e email enviado"}
 
-    user = await db.users.find_one({"id": user_id})
+    # Clear current password and set a new token with history tracking, in one round-trip
+    password_token = secrets.token_urlsafe(32)
+    user = await db.users.find_one_and_update(
+        {"id": user_id},
+        _user_token_refresh_pipeline(password_token, datetime.now(timezone.utc), clear_password=True),
+        projection={"_id": 0, "email": 1, "name": 1},
+        return_document=ReturnDocument.AFTER,
+    )
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Generate new token
-    password_token = secrets.token_urlsafe(32)
-    now_iso = datetime.now(timezone.utc).isoformat()
-    previous_token = user.get("password_creation_token")
-    
-    # Clear current password and set token with history tracking
-    update_doc = {
-        "$set": {
-            "password": None,
-            "password_creation_token": password_token,
-            "password_token_expires": (datetime.now(timezone.utc) + timedelta(days=7)).isoformat(),
-            "updated_at": now_iso,
-        },
-        "$addToSet": {
-            "password_token_history": {"$each": [password_token]},
-        },
-    }
-    if previous_token:
-        update_doc["$addToSet"]["password_token_history"]["$each"].append(previous_token)
-    
-    await db.users.update_one({"id": user_id}, update_doc)
-    
     # Send email
     try:
         frontend_url = os.environ.get('FRONTEND_URL', 'http://localhost:3000')
         password_link = f"{frontend_url}/create-password?token={password_token}"
         
         # Send email in background
-        loop = asyncio.get_event_loop()
-        loop.run_in_executor(
-            executor,
-            send_password_reset_email,
+        await enqueue_email(
+            "password_reset",
             user["email"],
-            user["name"],
-            password_link
+            {"name": user["name"], "password_link": password_link},
+            idempotency_key=f"password_reset:{password_token}",
         )
         
         logger.info(f"🔐 Password reset for {user['email']} by admin {current_user.email}")
@@ -7558,7 +8077,7 @@ async def impersonate_user(user_id: str, current_admin: User = Depends(get_curre
     if user_id == current_admin.id:
         raise HTTPException(status_code=400, detail="Você já está autenticado como este usuário.")
 
-    user_doc = await db.users.find_one({"id": user_id}, {"_id": 0})
+    user_doc = await db.users.find_one({"id": user_id}, USER_PROJECTION)
     if not user_doc:
         raise HTTPException(status_code=404, detail="Usuário não encontrado")
 
@@ -7575,63 +8094,21 @@ async def impersonate_user(user_id: str, current_admin: User = Depends(get_curre
         impersonated_user.email,
         impersonated_user.id,
     )
-
-    return Token(access_token=access_token, token_type="bearer", user=impersonated_user)
-
-# Helper function to send password reset email
-def send_password_reset_email(email: str, name: str, password_link: str):
-    """Send password reset email via SMTP"""
-    try:
-        import smtplib
-        from email.mime.text import MIMEText
-        from email.mime.multipart import MIMEMultipart
-        
-        # Get Brevo configuration synchronously
-        from pymongo import MongoClient
-        mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-        sync_client = MongoClient(mongo_url)
-        sync_db = sync_client[os.environ.get('DB_NAME', 'hiperautomacao_db')]
-        
-        config = sync_db.email_config.find_one({})
-        
-        if not config:
-            logger.warning("No email configuration found, skipping reset email")
-            sync_client.close()
-            return
-        
-        sender_email = config.get('sender_email')
-        sender_name = config.get('sender_name', 'Hiperautomação')
-        
-        # Get SMTP credentials (priority: smtp_username/password, fallback to old method)
-        smtp_username = config.get('smtp_username')
-        smtp_password = config.get('smtp_password')
-        smtp_server = config.get('smtp_server', 'smtp-relay.brevo.com')
-        smtp_port = config.get('smtp_port', 587)
-        
-        # Fallback to old method if new fields not set
-        if not smtp_username or not smtp_password:
-            smtp_username = config.get('sender_email')
-            smtp_password = config.get('brevo_smtp_key') or config.get('brevo_api_key')
-        
-        if not smtp_username or not smtp_password:
-            logger.error("No SMTP credentials found in configuration")
-            sync_client.close()
-            return
-        
-        # Create message
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = 'Redefinir Senha - Hiperautomação'
-        msg['From'] = f"{sender_name} <{sender_email}>"
-        msg['To'] = email
-        
-        html_content = f"""
+
+    return Token(access_token=access_token, token_type="bearer", user=impersonated_user)
+
+# Helper function to send password reset email
+PASSWORD_RESET_EMAIL_SUBJECT = 'Redefinir Senha - Hiperautomação'
+
+
+_PASSWORD_RESET_TPL = _email_templates.from_string("""
         <html>
         <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
             <h2 style="color: #10b981;">Redefinir Senha</h2>
-            <p>Olá {name},</p>
+            <p>Olá {{ name }},</p>
             <p>Um administrador solicitou a redefinição da sua senha.</p>
             <p style="margin: 30px 0;">
-                <a href="{password_link}" 
+                <a href="{{ password_link }}" 
                    style="background-color: #10b981; color: white; padding: 12px 30px; 
                           text-decoration: none; border-radius: 5px; display: inline-block;">
                     Criar Nova Senha
@@ -7643,88 +8120,35 @@ def send_password_reset_email(email: str, name: str, password_link: str):
             </p>
         </body>
         </html>
-        """
-        
-        part = MIMEText(html_content, 'html')
-        msg.attach(part)
-        
-        # Send via SMTP
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_username, smtp_password)
-            server.send_message(msg)
-        
-        logger.info(f"✅ Password reset email sent successfully to {email} via SMTP")
-        sync_client.close()
-        
-    except Exception as e:
-        logger.error(f"❌ Failed to send password reset email to {email}: {e}")
+        """)
 
 
-# Helper: send subscription activation email
-def send_subscription_activation_email(
-    email: str,
-    name: str,
-    login_url: str,
-    valid_until_iso: Optional[str] = None,
-    auto_renew: Optional[bool] = None,
-):
-    """Send subscription activation email via SMTP"""
-    try:
-        import smtplib
-        from email.mime.text import MIMEText
-        from email.mime.multipart import MIMEMultipart
-
-        # Get Brevo configuration synchronously
-        from pymongo import MongoClient
-        mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-        sync_client = MongoClient(mongo_url)
-        sync_db = sync_client[os.environ.get('DB_NAME', 'hiperautomacao_db')]
+def _build_password_reset_html(name: str, password_link: str) -> str:
+    return _PASSWORD_RESET_TPL.render(name=name, password_link=password_link)
 
-        config = sync_db.email_config.find_one({})
-        if not config:
-            logger.warning("No email configuration found, skipping activation email")
-            sync_client.close()
-            return
 
-        sender_email = config.get('sender_email')
-        sender_name = config.get('sender_name', 'Hiperautomação')
-
-        smtp_username = config.get('smtp_username')
-        smtp_password = config.get('smtp_password')
-        smtp_server = config.get('smtp_server', 'smtp-relay.brevo.com')
-        smtp_port = config.get('smtp_port', 587)
-        if not smtp_username or not smtp_password:
-            smtp_username = config.get('sender_email')
-            smtp_password = config.get('brevo_smtp_key') or config.get('brevo_api_key')
-        if not smtp_username or not smtp_password:
-            logger.error("No SMTP credentials found in configuration")
-            sync_client.close()
-            return
+async def send_password_reset_email_async(email: str, name: str, password_link: str) -> bool:
+    """Send password reset email via SMTP without blocking the event loop"""
+    return await _send_html_email_async(
+        "password reset",
+        email,
+        PASSWORD_RESET_EMAIL_SUBJECT,
+        _build_password_reset_html(name, password_link),
+    )
 
-        # Compose message
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = 'Assinatura Ativada - Hiperautomação'
-        msg['From'] = f"{sender_name} <{sender_email}>"
-        msg['To'] = email
 
-        renewal_text = ''
-        formatted_date = format_datetime_human(valid_until_iso)
-        if formatted_date:
-            if auto_renew:
-                renewal_text = f"<p>Renovação automática em: <strong>{formatted_date}</strong></p>"
-            else:
-                renewal_text = f"<p>Seu acesso atual vai até: <strong>{formatted_date}</strong></p>"
+# Helper: send subscription activation email
+SUBSCRIPTION_ACTIVATION_EMAIL_SUBJECT = 'Assinatura Ativada - Hiperautomação'
 
-        html_content = f"""
+_SUBSCRIPTION_ACTIVATION_TPL = _email_templates.from_string("""
         <html>
         <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
             <h2 style="color: #10b981;">Assinatura ativa! 🎉</h2>
-            <p>Olá {name or ''},</p>
+            <p>Olá {{ name or '' }},</p>
             <p>Sua assinatura foi ativada com sucesso. Agora você já pode acessar a plataforma.</p>
-            {renewal_text}
+            {% if formatted_date %}{% if auto_renew %}<p>Renovação automática em: <strong>{{ formatted_date }}</strong></p>{% else %}<p>Seu acesso atual vai até: <strong>{{ formatted_date }}</strong></p>{% endif %}{% endif %}
             <p style="margin: 30px 0;">
-                <a href="{login_url}" 
+                <a href="{{ login_url }}" 
                    style="background-color: #10b981; color: white; padding: 12px 30px; 
                           text-decoration: none; border-radius: 5px; display: inline-block;">
                     Acessar Plataforma
@@ -7733,103 +8157,194 @@ def send_subscription_activation_email(
             <p>Use seu email para login. Se não tiver senha, crie uma na opção "Esqueci minha senha".</p>
         </body>
         </html>
-        """
+        """)
 
-        part = MIMEText(html_content, 'html')
-        msg.attach(part)
 
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_username, smtp_password)
-            server.send_message(msg)
+def _build_subscription_activation_html(
+    name: str,
+    login_url: str,
+    valid_until_iso: Optional[str] = None,
+    auto_renew: Optional[bool] = None,
+) -> str:
+    return _SUBSCRIPTION_ACTIVATION_TPL.render(
+        name=name,
+        login_url=login_url,
+        formatted_date=format_datetime_human(valid_until_iso),
+        auto_renew=auto_renew,
+    )
+
 
-        logger.info(f"✅ Subscription activation email sent successfully to {email}")
-        sync_client.close()
-    except Exception as e:
-        logger.error(f"❌ Failed to send activation email to {email}: {e}")
+async def send_subscription_activation_email_async(
+    email: str,
+    name: str,
+    login_url: str,
+    valid_until_iso: Optional[str] = None,
+    auto_renew: Optional[bool] = None,
+) -> bool:
+    """Send subscription activation email via SMTP without blocking the event loop"""
+    return await _send_html_email_async(
+        "activation",
+        email,
+        SUBSCRIPTION_ACTIVATION_EMAIL_SUBJECT,
+        _build_subscription_activation_html(name, login_url, valid_until_iso, auto_renew),
+    )
 
 
 # Helper: send subscription cancellation email
-def send_subscription_cancellation_email(
+SUBSCRIPTION_CANCELLATION_EMAIL_SUBJECT = 'Assinatura Cancelada - Hiperautomação'
+
+_SUBSCRIPTION_CANCELLATION_TPL = _email_templates.from_string("""
+        <html>
+        <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
+            <h2 style="color: #ef4444;">Assinatura cancelada</h2>
+            <p>Olá {{ name or '' }},</p>
+            {% if immediate or not formatted_date %}<p>Sua assinatura foi cancelada e o acesso foi encerrado imediatamente.</p><p>Para voltar a estudar, faça uma nova assinatura em <a href="{{ subscribe_url }}">{{ subscribe_url }}</a>.</p>{% else %}<p>Sua assinatura foi cancelada. Você ainda terá acesso até <strong>{{ formatted_date }}</strong>.</p><p>Se desejar continuar após essa data, renove em <a href="{{ subscribe_url }}">{{ subscribe_url }}</a>.</p>{% endif %}
+        </body>
+        </html>
+        """)
+
+
+def _build_subscription_cancellation_html(
+    name: str,
+    valid_until_iso: Optional[str] = None,
+    immediate: bool = False,
+) -> str:
+    return _SUBSCRIPTION_CANCELLATION_TPL.render(
+        name=name,
+        formatted_date=format_datetime_human(valid_until_iso),
+        immediate=immediate,
+        subscribe_url=f"{get_frontend_url().rstrip('/')}/subscribe",
+    )
+
+
+async def send_subscription_cancellation_email_async(
     email: str,
     name: str,
     valid_until_iso: Optional[str] = None,
     immediate: bool = False,
-):
-    """Send subscription cancellation email via SMTP"""
-    try:
-        import smtplib
-        from email.mime.text import MIMEText
-        from email.mime.multipart import MIMEMultipart
+) -> bool:
+    """Send subscription cancellation email via SMTP without blocking the event loop"""
+    return await _send_html_email_async(
+        "cancellation",
+        email,
+        SUBSCRIPTION_CANCELLATION_EMAIL_SUBJECT,
+        _build_subscription_cancellation_html(name, valid_until_iso, immediate),
+    )
 
-        # Get Brevo configuration synchronously
-        from pymongo import MongoClient
-        mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-        sync_client = MongoClient(mongo_url)
-        sync_db = sync_client[os.environ.get('DB_NAME', 'hiperautomacao_db')]
 
-        config = sync_db.email_config.find_one({})
-        if not config:
-            logger.warning("No email configuration found, skipping cancellation email")
-            sync_client.close()
-            return
+# ==================== EMAIL OUTBOX ====================
+# Outbound emails are persisted in email_outbox and delivered by a background
+# drainer with exponential backoff, so SMTP outages or Brevo rate limits delay
+# emails instead of losing them. Rows are claimed with a lease so several
+# worker processes can drain the same collection without double-sending.
 
-        sender_email = config.get('sender_email')
-        sender_name = config.get('sender_name', 'Hiperautomação')
-
-        smtp_username = config.get('smtp_username')
-        smtp_password = config.get('smtp_password')
-        smtp_server = config.get('smtp_server', 'smtp-relay.brevo.com')
-        smtp_port = config.get('smtp_port', 587)
-        if not smtp_username or not smtp_password:
-            smtp_username = config.get('sender_email')
-            smtp_password = config.get('brevo_smtp_key') or config.get('brevo_api_key')
-        if not smtp_username or not smtp_password:
-            logger.error("No SMTP credentials found in configuration")
-            sync_client.close()
-            return
+EMAIL_OUTBOX_SENDERS = {
+    "password_creation": send_password_creation_email_async,
+    "password_reset": send_password_reset_email_async,
+    "subscription_activation": send_subscription_activation_email_async,
+    "subscription_cancellation": send_subscription_cancellation_email_async,
+}
+EMAIL_OUTBOX_POLL_SECONDS = 2.0
+EMAIL_OUTBOX_BATCH_SIZE = 20
+EMAIL_OUTBOX_MAX_ATTEMPTS = 8
+EMAIL_OUTBOX_MAX_BACKOFF_SECONDS = 300
+EMAIL_OUTBOX_LEASE_SECONDS = 300
 
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = 'Assinatura Cancelada - Hiperautomação'
-        msg['From'] = f"{sender_name} <{sender_email}>"
-        msg['To'] = email
+_email_outbox_task: Optional[asyncio.Task] = None
 
-        formatted_date = format_datetime_human(valid_until_iso)
-        subscribe_url = f"{get_frontend_url().rstrip('/')}/subscribe"
 
-        if immediate or not formatted_date:
-            status_paragraph = (
-                "<p>Sua assinatura foi cancelada e o acesso foi encerrado imediatamente.</p>"
-                f"<p>Para voltar a estudar, faça uma nova assinatura em <a href=\"{subscribe_url}\">{subscribe_url}</a>.</p>"
-            )
-        else:
-            status_paragraph = (
-                f"<p>Sua assinatura foi cancelada. Você ainda terá acesso até <strong>{formatted_date}</strong>.</p>"
-                f"<p>Se desejar continuar após essa data, renove em <a href=\"{subscribe_url}\">{subscribe_url}</a>.</p>"
-            )
+async def enqueue_email(email_type: str, to: Optional[str], payload: dict, idempotency_key: Optional[str] = None) -> None:
+    """Persist an outbound email for the outbox drainer; duplicate idempotency keys are ignored."""
+    if email_type not in EMAIL_OUTBOX_SENDERS:
+        raise ValueError(f"Unknown email type: {email_type}")
+    if not to:
+        logger.warning("Skipping %s email without recipient", email_type)
+        return
+    now = datetime.now(timezone.utc)
+    doc = {
+        "id": str(uuid.uuid4()),
+        "type": email_type,
+        "to": to,
+        "payload": payload,
+        "attempts": 0,
+        "status": "pending",
+        "next_attempt_at": now,
+        "created_at": now,
+    }
+    if idempotency_key:
+        doc["idempotency_key"] = idempotency_key
+    try:
+        await db.email_outbox.insert_one(doc)
+    except DuplicateKeyError:
+        logger.info("Email %s already queued, skipping", idempotency_key)
 
-        html_content = f"""
-        <html>
-        <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
-            <h2 style="color: #ef4444;">Assinatura cancelada</h2>
-            <p>Olá {name or ''},</p>
-            {status_paragraph}
-        </body>
-        </html>
-        """
 
-        part = MIMEText(html_content, 'html')
-        msg.attach(part)
+async def _deliver_outbox_email(doc: dict) -> bool:
+    sender = EMAIL_OUTBOX_SENDERS.get(doc.get("type"))
+    if sender is None:
+        logger.error("Email outbox entry %s has unknown type %s", doc.get("id"), doc.get("type"))
+        return False
+    try:
+        return bool(await sender(doc["to"], **(doc.get("payload") or {})))
+    except Exception as exc:
+        logger.error("Email outbox entry %s failed: %s", doc.get("id"), exc)
+        return False
 
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_username, smtp_password)
-            server.send_message(msg)
 
-        logger.info(f"✅ Subscription cancellation email sent successfully to {email}")
-        sync_client.close()
-    except Exception as e:
-        logger.error(f"❌ Failed to send cancellation email to {email}: {e}")
+async def _drain_email_outbox_once() -> int:
+    now = datetime.now(timezone.utc)
+    due_filter = {
+        "$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            # Claimed by a worker that died mid-send
+            {"status": "sending", "claimed_at": {"$lt": now - timedelta(seconds=EMAIL_OUTBOX_LEASE_SECONDS)}},
+        ]
+    }
+    due = await db.email_outbox.find(due_filter, {"_id": 0, "id": 1}).limit(EMAIL_OUTBOX_BATCH_SIZE).to_list(EMAIL_OUTBOX_BATCH_SIZE)
+    if not due:
+        return 0
+
+    claim_id = str(uuid.uuid4())
+    await db.email_outbox.update_many(
+        {"id": {"$in": [d["id"] for d in due]}, **due_filter},
+        {"$set": {"status": "sending", "claim_id": claim_id, "claimed_at": now}},
+    )
+    claimed = await db.email_outbox.find({"claim_id": claim_id, "status": "sending"}, {"_id": 0}).to_list(EMAIL_OUTBOX_BATCH_SIZE)
+    if not claimed:
+        return 0
+
+    results = await asyncio.gather(*(_deliver_outbox_email(doc) for doc in claimed))
+    finished_at = datetime.now(timezone.utc)
+    ops = []
+    for doc, sent in zip(claimed, results):
+        if sent:
+            ops.append(UpdateOne({"id": doc["id"]}, {"$set": {"status": "sent", "sent_at": finished_at}}))
+            continue
+        attempts = int(doc.get("attempts") or 0) + 1
+        delay = min(EMAIL_OUTBOX_MAX_BACKOFF_SECONDS, 2 ** attempts)
+        ops.append(UpdateOne(
+            {"id": doc["id"]},
+            {"$set": {
+                "status": "failed" if attempts >= EMAIL_OUTBOX_MAX_ATTEMPTS else "pending",
+                "attempts": attempts,
+                "next_attempt_at": finished_at + timedelta(seconds=delay),
+            }},
+        ))
+    await db.email_outbox.bulk_write(ops, ordered=False)
+    return len(claimed)
+
+
+async def _drain_email_outbox():
+    while True:
+        try:
+            processed = await _drain_email_outbox_once()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.warning("Email outbox drain failed: %s", exc)
+            processed = 0
+        if processed < EMAIL_OUTBOX_BATCH_SIZE:
+            await asyncio.sleep(EMAIL_OUTBOX_POLL_SECONDS)
 
 
 # ==================== GAMIFICATION SYSTEM ====================
@@ -7877,6 +8392,7 @@ async def update_gamification_settings(
         {"$set": settings},
         upsert=True
     )
+    invalidate_singleton_cache("gamification_settings")
     
     logger.info(f"Admin {current_user.email} updated gamification settings")
     
@@ -7885,45 +8401,113 @@ async def update_gamification_settings(
 # Helper function to get reward amount
 async def get_reward_amount(action_type: str) -> int:
     """Get reward amount for a specific action"""
-    settings = await db.gamification_settings.find_one({}, {"_id": 0})
+    settings = await cached_singleton("gamification_settings")
     
     if not settings:
         return DEFAULT_REWARDS.get(action_type, 0)
     
     return settings.get(action_type, 0)
 
+# Access checks behind gamification logging are cached briefly; a stale answer only
+# affects a log line
+GAMIFICATION_ACCESS_CACHE_TTL_SECONDS = 30.0
+GAMIFICATION_ACCESS_CACHE_MAX = 10000
+_gamification_access_cache: "OrderedDict[str, tuple]" = OrderedDict()
+# Only the fields user_has_access/build_subscription_snapshot read, plus email for the log line
+GAMIFICATION_USER_PROJECTION = {
+    "_id": 0,
+    "email": 1,
+    "has_full_access": 1,
+    "subscription_plan_id": 1,
+    "subscription_valid_until": 1,
+    "subscription_auto_renew": 1,
+    "subscription_cancel_at_period_end": 1,
+    "subscription_cancelled": 1,
+}
+
+
 # Helper function to give gamification reward
 async def give_gamification_reward(user_id: str, action_type: str, description: str):
     """Log gamification action (credits system removed)"""
-    logger.info(f"🎮 Gamification action logged for user {user_id}, action: {action_type}")
-    
-    user = await db.users.find_one({"id": user_id})
-    
-    if not user:
-        logger.warning(f"❌ User {user_id} not found for gamification action")
+    if await get_reward_amount(action_type) == 0:
         return False
+
+    logger.info(f"🎮 Gamification action logged for user {user_id}, action: {action_type}")
     
-    # Only log for users who have access to at least one course
-    has_access = await user_has_access(user_id)
+    now = time.monotonic()
+    entry = _gamification_access_cache.get(user_id)
+    if entry is not None and now < entry[2]:
+        email, has_access = entry[0], entry[1]
+    else:
+        _gamification_access_cache.pop(user_id, None)
+        user = await db.users.find_one({"id": user_id}, GAMIFICATION_USER_PROJECTION)
+        if not user:
+            logger.warning(f"❌ User {user_id} not found for gamification action")
+            return False
+        email = user.get("email")
+        # Only log for users who have access to at least one course
+        has_access = await user_has_access(user_id, user)
+        _gamification_access_cache[user_id] = (email, has_access, now + GAMIFICATION_ACCESS_CACHE_TTL_SECONDS)
+        while len(_gamification_access_cache) > GAMIFICATION_ACCESS_CACHE_MAX:
+            _gamification_access_cache.popitem(last=False)
+
     if not has_access:
-        logger.info(f"❌ User {user.get('email')} has no course access, no gamification action logged for {action_type}")
+        logger.info(f"❌ User {email} has no course access, no gamification action logged for {action_type}")
         return False
     
-    logger.info(f"✅ Gamification action {action_type} logged for user {user.get('email')}")
+    logger.info(f"✅ Gamification action {action_type} logged for user {email}")
     return True
 
+
+class BillingStatus(str, Enum):
+    PENDING = "pending"
+    PAID = "paid"
+    FAILED = "failed"
+    CANCELED = "canceled"
+
+
+# A billing in one of these states will not change again, so a wait for another status ends early
+BILLING_TERMINAL_STATUSES = frozenset({
+    BillingStatus.PAID.value,
+    BillingStatus.FAILED.value,
+    BillingStatus.CANCELED.value,
+})
+
+# Interval between billing re-reads while a caller waits for a status change
+BILLING_WAIT_POLL_SECONDS = 0.1
+
 # Get billing status
 @api_router.get("/billing/{billing_id}")
-async def get_billing_status(billing_id: str, current_user: User = Depends(get_current_user)):
-    """Get billing status"""
-    billing = await db.billings.find_one(
-        {"billing_id": billing_id, "user_id": current_user.id},
-        {"_id": 0}
-    )
+async def get_billing_status(
+    billing_id: str,
+    wait: Optional[BillingStatus] = None,
+    timeout_ms: int = Query(2000, ge=0, le=2000),
+    current_user: User = Depends(get_current_user),
+):
+    """Get billing status.
+
+    With ``wait=<status>`` the request is held until the billing reaches that status
+    or ``timeout_ms`` elapses, so callers waiting on the payment webhook do not have
+    to poll from the client. The webhook may land on another worker, so the wait
+    re-reads the billing instead of relying on in-process signals. A billing already
+    in a terminal status is returned at once.
+    """
+    query = {"billing_id": billing_id, "user_id": current_user.id}
+    billing = await db.billings.find_one(query, {"_id": 0})
     
     if not billing:
         raise HTTPException(status_code=404, detail="Billing not found")
     
+    if wait:
+        deadline = time.monotonic() + timeout_ms / 1000
+        while (
+            billing.get("status") != wait.value
+            and billing.get("status") not in BILLING_TERMINAL_STATUSES
+            and time.monotonic() < deadline
+        ):
+            await asyncio.sleep(BILLING_WAIT_POLL_SECONDS)
+            billing = await db.billings.find_one(query, {"_id": 0}) or billing
+    
     return billing
 
 # Admin: Update course prices
@@ -7956,18 +8540,84 @@ async def update_course_pricing(
 
 # ==================== LEAD CAPTURE ENDPOINTS ====================
 
+# Brazilian area codes (DDD) used to recognise local numbers without country code
+_BR_DDDS = frozenset({'11', '12', '13', '14', '15', '16', '17', '18', '19', '21', '22', '24', '27', '28', '31', '32', '33', '34', '35', '37', '38', '41', '42', '43', '44', '45', '46', '47', '48', '49', '51', '53', '54', '55', '61', '62', '63', '64', '65', '66', '67', '68', '69', '71', '73', '74', '75', '77', '79', '81', '82', '83', '84', '85', '86', '87', '88', '89', '91', '92', '93', '94', '95', '96', '97', '98', '99'})
+_NON_DIGIT_RE = re.compile(r'\D')
+
+# Shared keep-alive client so consecutive lead captures reuse the TLS connection to Brevo
+BREVO_API_BASE_URL = "https://api.brevo.com"
+_brevo_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_brevo_http_client() -> httpx.AsyncClient:
+    global _brevo_http_client
+    if _brevo_http_client is None or _brevo_http_client.is_closed:
+        _brevo_http_client = httpx.AsyncClient(
+            base_url=BREVO_API_BASE_URL,
+            timeout=10.0,
+            limits=httpx.Limits(max_keepalive_connections=10),
+        )
+    return _brevo_http_client
+
+# Successful captures are buffered and written with one insert_many per burst; failed
+# captures are inserted directly so they are always on record
+LEAD_FLUSH_MAX_BATCH = 500
+LEAD_FLUSH_INTERVAL_SECONDS = 0.2
+lead_queue: "asyncio.Queue[dict]" = asyncio.Queue()
+_lead_flush_task: Optional[asyncio.Task] = None
+
+
+def _take_queued_leads(limit: int) -> List[dict]:
+    docs = []
+    while len(docs) < limit:
+        try:
+            docs.append(lead_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return docs
+
+
+async def _insert_leads(docs: List[dict]) -> None:
+    try:
+        await db.leads.insert_many(docs, ordered=False)
+    except Exception as exc:
+        logger.error("Failed to store %s lead(s): %s", len(docs), exc)
+
+
+async def _flush_leads():
+    while True:
+        first = await lead_queue.get()
+        try:
+            await asyncio.sleep(LEAD_FLUSH_INTERVAL_SECONDS)
+        except asyncio.CancelledError:
+            lead_queue.put_nowait(first)
+            raise
+        await _insert_leads([first] + _take_queued_leads(LEAD_FLUSH_MAX_BATCH - 1))
+
+
+async def flush_pending_leads() -> None:
+    while docs := _take_queued_leads(LEAD_FLUSH_MAX_BATCH):
+        await _insert_leads(docs)
+
+
 @api_router.post("/leads/capture")
 async def capture_lead(lead_data: LeadCaptureRequest):
     """Capture lead and send to Brevo"""
+    # Store lead locally sempre, independente do resultado do Brevo
+    lead_doc = {
+        "name": lead_data.name,
+        "email": lead_data.email,
+        "whatsapp": lead_data.whatsapp,
+        "created_at": datetime.now(timezone.utc),
+        "sent_to_brevo": False,
+        "error": None
+    }
     try:
         # Get Brevo configuration
-        brevo_config = await db.brevo_config.find_one({})
+        brevo_config = await cached_singleton("brevo_config")
         if not brevo_config or not brevo_config.get("api_key"):
             raise HTTPException(status_code=500, detail="Brevo configuration not found")
         
-        # Send to Brevo
-        import requests
-        
         # Normalizar número de WhatsApp para o formato aceito pelo Brevo
         def normalize_whatsapp(whatsapp_number):
             """Normaliza número de WhatsApp para formato internacional"""
@@ -7975,23 +8625,24 @@ async def capture_lead(lead_data: LeadCaptureRequest):
                 return None
             
             # Remove todos os caracteres não numéricos
-            clean_number = ''.join(filter(str.isdigit, whatsapp_number))
+            clean_number = _NON_DIGIT_RE.sub('', whatsapp_number)
+            
+            # Número local (DDD + telefone): adiciona o código do país (Brasil)
+            if len(clean_number) in (10, 11) and clean_number[:2] in _BR_DDDS:
+                clean_number = f"55{clean_number}"
             
-            # Verificar se o número tem um tamanho válido
-            if len(clean_number) < 10 or len(clean_number) > 15:
-                logger.warning(f"WhatsApp number invalid length: {whatsapp_number} (cleaned: {clean_number})")
+            # Brevo rejeita números fora do padrão E.164 brasileiro; validar aqui evita
+            # uma segunda chamada à API só para reenviar o contato sem WhatsApp
+            if len(clean_number) not in (12, 13) or not clean_number.startswith('55') or clean_number[2:4] not in _BR_DDDS:
+                logger.warning(f"WhatsApp number invalid: {whatsapp_number} (cleaned: {clean_number})")
                 return None
             
-            # Se não começar com código do país, adiciona +55 (Brasil)
-            if len(clean_number) == 11 and clean_number.startswith(('11', '12', '13', '14', '15', '16', '17', '18', '19', '21', '22', '24', '27', '28', '31', '32', '33', '34', '35', '37', '38', '41', '42', '43', '44', '45', '46', '47', '48', '49', '51', '53', '54', '55', '61', '62', '63', '64', '65', '66', '67', '68', '69', '71', '73', '74', '75', '77', '79', '81', '82', '83', '84', '85', '86', '87', '88', '89', '91', '92', '93', '94', '95', '96', '97', '98', '99')):
-                return f"+55{clean_number}"
-            elif len(clean_number) == 13 and clean_number.startswith('55'):
-                return f"+{clean_number}"
-            elif clean_number.startswith('55') and len(clean_number) > 11:
-                return f"+{clean_number}"
+            # Celulares (9 dígitos após o DDD) sempre começam com 9
+            if len(clean_number) == 13 and clean_number[4] != '9':
+                logger.warning(f"WhatsApp mobile number without leading 9: {whatsapp_number} (cleaned: {clean_number})")
+                return None
             
-            # Se já tem código do país, mantém
-            return f"+{clean_number}" if not whatsapp_number.startswith('+') else whatsapp_number
+            return f"+{clean_number}"
 
         headers = {
             "accept": "application/json",
@@ -8000,11 +8651,11 @@ async def capture_lead(lead_data: LeadCaptureRequest):
         }
         
         # Função para tentar enviar para Brevo
-        def try_send_to_brevo(contact_data, attempt_description):
+        async def try_send_to_brevo(contact_data, attempt_description):
             logger.info(f"Sending to Brevo ({attempt_description}): {json.dumps(contact_data, indent=2)}")
             
-            response = requests.post(
-                "https://api.brevo.com/v3/contacts",
+            response = await _get_brevo_http_client().post(
+                "/v3/contacts",
                 json=contact_data,
                 headers=headers
             )
@@ -8025,7 +8676,7 @@ async def capture_lead(lead_data: LeadCaptureRequest):
                 "listIds": [brevo_config.get("list_id")] if brevo_config.get("list_id") else []
             }
             
-            response = try_send_to_brevo(contact_data, "with WhatsApp")
+            response = await try_send_to_brevo(contact_data, "with WhatsApp")
         else:
             # WhatsApp inválido, tentar direto sem WhatsApp
             logger.info("WhatsApp number invalid, sending without WhatsApp field")
@@ -8037,7 +8688,7 @@ async def capture_lead(lead_data: LeadCaptureRequest):
                 "listIds": [brevo_config.get("list_id")] if brevo_config.get("list_id") else []
             }
             
-            response = try_send_to_brevo(contact_data, "without WhatsApp (invalid number)")
+            response = await try_send_to_brevo(contact_data, "without WhatsApp (invalid number)")
         
         brevo_success = False
         brevo_error = None
@@ -8076,7 +8727,7 @@ async def capture_lead(lead_data: LeadCaptureRequest):
                             "listIds": [brevo_config.get("list_id")] if brevo_config.get("list_id") else []
                         }
                         
-                        response_retry = try_send_to_brevo(contact_data_no_whatsapp, "without WhatsApp")
+                        response_retry = await try_send_to_brevo(contact_data_no_whatsapp, "without WhatsApp")
                         
                         if response_retry.status_code in [200, 201, 204]:
                             brevo_success = True
@@ -8088,10 +8739,30 @@ async def capture_lead(lead_data: LeadCaptureRequest):
                     elif error_code == "duplicate_parameter":
                         duplicate_fields = error_data.get("metadata", {}).get("duplicate_identifiers", [])
                         if "WHATSAPP" in duplicate_fields:
-                            raise HTTPException(
-                                status_code=409, 
-                                detail="Este número de WhatsApp já está cadastrado em nossa base de dados"
+                            # Número já pertence a um contato: atualizar o contato pelo email (idempotente)
+                            # em vez de repetir o POST
+                            logger.info("WhatsApp number already registered in Brevo, updating contact by email")
+                            update_data = {"attributes": {"NOME": lead_data.name}}
+                            if brevo_config.get("list_id"):
+                                update_data["listIds"] = [brevo_config.get("list_id")]
+                            response_update = await _get_brevo_http_client().put(
+                                f"/v3/contacts/{quote(lead_data.email)}",
+                                json=update_data,
+                                headers=headers
                             )
+                            if response_update.status_code == 404:
+                                # Email ainda não existe no Brevo: criar o contato sem o WhatsApp duplicado
+                                response_update = await try_send_to_brevo(
+                                    {**update_data, "email": lead_data.email},
+                                    "without WhatsApp (duplicate number)"
+                                )
+                            
+                            if response_update.status_code in [200, 201, 204]:
+                                brevo_success = True
+                                logger.info("Lead successfully sent to Brevo without duplicate WhatsApp")
+                            else:
+                                brevo_error = f"Erro na API do Brevo: {response_update.status_code}"
+                                logger.error(f"Failed to update Brevo contact: {response_update.text}")
                         elif "email" in duplicate_fields or any("email" in field.lower() for field in duplicate_fields):
                             raise HTTPException(
                                 status_code=409, 
@@ -8119,17 +8790,8 @@ async def capture_lead(lead_data: LeadCaptureRequest):
         else:
             brevo_success = True
         
-        # Store lead locally sempre, independente do resultado do Brevo
-        lead_doc = {
-            "name": lead_data.name,
-            "email": lead_data.email,
-            "whatsapp": lead_data.whatsapp,
-            "created_at": datetime.now(timezone.utc),
-            "sent_to_brevo": brevo_success,
-            "error": brevo_error if not brevo_success else None
-        }
-        
-        await db.leads.insert_one(lead_doc)
+        lead_doc["sent_to_brevo"] = brevo_success
+        lead_doc["error"] = brevo_error if not brevo_success else None
         
         if brevo_success:
             logger.info(f"Lead captured and sent to Brevo: {lead_data.email}")
@@ -8141,34 +8803,20 @@ async def capture_lead(lead_data: LeadCaptureRequest):
     except HTTPException as he:
         # Re-raise HTTPExceptions (like IP authorization errors and duplicates)
         logger.error(f"HTTP Error capturing lead: {he.detail}")
-        # Store lead locally even if there's an HTTP error
-        lead_doc = {
-            "name": lead_data.name,
-            "email": lead_data.email,
-            "whatsapp": lead_data.whatsapp,
-            "created_at": datetime.now(timezone.utc),
-            "sent_to_brevo": False,
-            "error": he.detail
-        }
-        
-        await db.leads.insert_one(lead_doc)
+        lead_doc["error"] = he.detail
         raise he
         
     except Exception as e:
         logger.error(f"Error capturing lead: {str(e)}")
-        # Store lead locally even if Brevo fails
-        lead_doc = {
-            "name": lead_data.name,
-            "email": lead_data.email,
-            "whatsapp": lead_data.whatsapp,
-            "created_at": datetime.now(timezone.utc),
-            "sent_to_brevo": False,
-            "error": str(e)
-        }
-        
-        await db.leads.insert_one(lead_doc)
+        lead_doc["error"] = str(e)
         raise HTTPException(status_code=500, detail="Error processing lead capture")
 
+    finally:
+        if lead_doc["sent_to_brevo"]:
+            lead_queue.put_nowait(lead_doc)
+        else:
+            await db.leads.insert_one(lead_doc)
+
 @api_router.get("/admin/brevo-config")
 async def get_brevo_config(current_user: User = Depends(get_current_admin)):
     """Get Brevo configuration (admin only)"""
@@ -8199,27 +8847,41 @@ async def update_brevo_config(
     }
     
     await db.brevo_config.replace_one({}, config_data, upsert=True)
+    invalidate_singleton_cache("brevo_config")
+    _BREVO_LISTS_CACHE["expires"] = 0
     
     logger.info(f"Admin {current_user.email} updated Brevo configuration")
     return {"message": "Brevo configuration updated successfully"}
 
+# Brevo lists shown on the admin dashboard, refreshed at most once a minute
+BREVO_LISTS_CACHE_TTL_SECONDS = 60
+_BREVO_LISTS_CACHE = {
+    "api_key": None,
+    "lists": None,
+    "expires": 0,
+}
+
 @api_router.get("/admin/brevo-lists")
 async def get_brevo_lists(current_user: User = Depends(get_current_admin)):
     """Get Brevo lists (admin only)"""
     try:
-        brevo_config = await db.brevo_config.find_one({})
+        brevo_config = await cached_singleton("brevo_config")
         if not brevo_config or not brevo_config.get("api_key"):
             raise HTTPException(status_code=400, detail="Brevo API key not configured")
         
-        import requests
+        if (
+            _BREVO_LISTS_CACHE["api_key"] == brevo_config["api_key"]
+            and time.monotonic() < _BREVO_LISTS_CACHE["expires"]
+        ):
+            return {"lists": _BREVO_LISTS_CACHE["lists"]}
         
         headers = {
             "accept": "application/json",
             "api-key": brevo_config["api_key"]
         }
         
-        response = requests.get(
-            "https://api.brevo.com/v3/contacts/lists",
+        response = await _get_brevo_http_client().get(
+            "/v3/contacts/lists",
             headers=headers
         )
         
@@ -8252,6 +8914,11 @@ async def get_brevo_lists(current_user: User = Depends(get_current_admin)):
                 "totalSubscribers": lst.get("totalSubscribers", 0)
             })
         
+        _BREVO_LISTS_CACHE.update({
+            "api_key": brevo_config["api_key"],
+            "lists": lists,
+            "expires": time.monotonic() + BREVO_LISTS_CACHE_TTL_SECONDS,
+        })
         return {"lists": lists}
         
     except HTTPException:
@@ -8263,7 +8930,7 @@ async def get_brevo_lists(current_user: User = Depends(get_current_admin)):
 @api_router.get("/leads/sales-page-url")
 async def get_sales_page_url():
     """Get sales page URL for lead redirection"""
-    config = await db.brevo_config.find_one({})
+    config = await cached_singleton("brevo_config")
     if not config or not config.get("sales_page_url"):
         return {"url": "https://exemplo.com/vendas"}  # URL padrão
     
@@ -8306,9 +8973,60 @@ class ReplicationConfigPayload(BaseModel):
     replication_enabled: bool = False
 
 
+# Rapid admin edits (toggle clicks, repeated saves) are coalesced into one encrypted
+# write; readers in this process see the pending config until it is flushed
+REPLICATION_CONFIG_SAVE_DEBOUNCE_SECONDS = 0.5
+REPLICATION_CONFIG_SAVE_ATTEMPTS = 3
+_pending_replication_config: Optional[Dict[str, Any]] = None
+_replication_config_save_task: Optional[asyncio.Task] = None
+
+
+def load_replication_config() -> Dict[str, Any]:
+    if _pending_replication_config is not None:
+        return dict(_pending_replication_config)
+    return load_config()
+
+
+def flush_replication_config() -> None:
+    """Write the pending config; it stays pending if the write fails so it can be retried."""
+    global _pending_replication_config
+    cfg = _pending_replication_config
+    if cfg is None:
+        return
+    save_config(cfg)
+    _pending_replication_config = None
+
+
+async def _save_replication_config_after_delay():
+    for attempt in range(1, REPLICATION_CONFIG_SAVE_ATTEMPTS + 1):
+        await asyncio.sleep(REPLICATION_CONFIG_SAVE_DEBOUNCE_SECONDS)
+        try:
+            flush_replication_config()
+            return
+        except Exception as exc:
+            logger.error(
+                "Failed to persist replication config (attempt %s/%s): %s",
+                attempt,
+                REPLICATION_CONFIG_SAVE_ATTEMPTS,
+                exc,
+            )
+            if attempt == REPLICATION_CONFIG_SAVE_ATTEMPTS:
+                raise
+
+
+async def save_replication_config(cfg: Dict[str, Any]) -> None:
+    """Queue ``cfg`` for the next coalesced write and wait until it is on disk; raises if the write fails."""
+    global _pending_replication_config, _replication_config_save_task
+    _pending_replication_config = dict(cfg)
+    if _replication_config_save_task is None or _replication_config_save_task.done():
+        _replication_config_save_task = spawn_background_task(_save_replication_config_after_delay())
+    # Shielded so a disconnecting client does not cancel a write other requests are waiting on
+    await asyncio.shield(_replication_config_save_task)
+
+
 @api_router.get("/admin/replication/status")
 async def get_replication_status(current_user: User = Depends(get_current_admin)):
-    cfg = load_config()
+    cfg = load_replication_config()
     return {
         "replication_enabled": replication_manager.enabled,
         "configured": bool(cfg.get("mongo_url") and cfg.get("db_name")),
@@ -8324,7 +9042,7 @@ async def get_replication_status(current_user: User = Depends(get_current_admin)
 
 @api_router.get("/admin/replication/config")
 async def get_replication_config(current_user: User = Depends(get_current_admin)):
-    cfg = load_config()
+    cfg = load_replication_config()
     # Normalize null values so the frontend form can be populated safely
     return {
         "mongo_url": cfg.get("mongo_url") or "",
@@ -8339,7 +9057,11 @@ async def get_replication_config(current_user: User = Depends(get_current_admin)
 async def set_replication_config(payload: ReplicationConfigPayload, current_user: User = Depends(get_current_admin)):
     config_dict = payload.model_dump()
     # Persist encrypted config
-    save_config(config_dict)
+    try:
+        await save_replication_config(config_dict)
+    except Exception as exc:
+        logger.exception("Erro ao salvar configuração de replicação: %s", exc)
+        raise HTTPException(status_code=500, detail="Não foi possível salvar a configuração de replicação")
     # Apply live configuration (do not fail save on configure errors)
     try:
         await replication_manager.configure(config_dict)
@@ -8353,22 +9075,43 @@ async def set_replication_config(payload: ReplicationConfigPayload, current_user
         }
 
 
+REPLICATION_TEST_TIMEOUT_MS = 3000
+
+
 @api_router.post("/admin/replication/test")
 async def test_replication_connection(payload: ReplicationConfigPayload, current_user: User = Depends(get_current_admin)):
     # Try connecting using provided config without persisting
     try:
         if not payload.mongo_url or not payload.db_name:
             raise HTTPException(status_code=400, detail="mongo_url e db_name são obrigatórios")
-        tmp_client = AsyncIOMotorClient(payload.mongo_url)
-        tmp_db = tmp_client[payload.db_name]
-        # Simple command to test connectivity
-        await tmp_db.command("ping")
-        tmp_client.close()
+        # Fail fast on unreachable hosts instead of the 30s default server selection
+        tmp_client = AsyncIOMotorClient(
+            payload.mongo_url,
+            serverSelectionTimeoutMS=REPLICATION_TEST_TIMEOUT_MS,
+            connectTimeoutMS=REPLICATION_TEST_TIMEOUT_MS,
+        )
+        try:
+            tmp_db = tmp_client[payload.db_name]
+            # Simple command to test connectivity
+            await asyncio.wait_for(tmp_db.command("ping"), timeout=REPLICATION_TEST_TIMEOUT_MS / 1000 + 1)
+        finally:
+            tmp_client.close()
         return {"ok": True, "message": "Conexão bem-sucedida"}
+    except asyncio.TimeoutError:
+        return {"ok": False, "message": "Tempo esgotado ao conectar ao MongoDB de replicação"}
     except Exception as exc:
         return {"ok": False, "message": str(exc)}
 
 # --- Full backup endpoint: copy all collections from primary to configured secondary ---
+# Each insert_many carries up to this many documents / approximately this many bytes
+BACKUP_MAX_BATCH_DOCS = 10_000
+BACKUP_MAX_BATCH_BYTES = 16 * 1024 * 1024
+# Bulk copy is re-runnable, so skip waiting on the secondary's journal
+BACKUP_WRITE_CONCERN = WriteConcern(w=1, j=False)
+# Collections copied at the same time during a full backup
+BACKUP_COPY_CONCURRENCY = 4
+
+
 @api_router.post("/admin/replication/backup")
 async def backup_full_database(current_user: User = Depends(get_current_admin)):
     """Copy all documents from the primary database to the configured replication database.
@@ -8388,38 +9131,44 @@ async def backup_full_database(current_user: User = Depends(get_current_admin)):
 
         replication_manager.audit.info(f"backup_start collections={len(coll_names)}")
 
-        summary = {}
-        total_docs = 0
-
-        for name in coll_names:
-            copied = 0
-            try:
-                # Drop target collection to ensure a clean copy
+        async def copy_collection(name: str):
+            async with copy_sem:
                 try:
-                    await secondary_db[name].drop()
-                except Exception:
-                    pass  # ignore if not exists
-
-                # Stream documents in batches to the secondary
-                batch = []
-                cursor = _primary_db[name].find({}, projection=None)
-                async for doc in cursor:
-                    batch.append(doc)
-                    if len(batch) >= 1000:
-                        await secondary_db[name].insert_many(batch, ordered=False)
+                    # Drop target collection to ensure a clean copy
+                    try:
+                        await secondary_db[name].drop()
+                    except Exception:
+                        pass  # ignore if not exists
+
+                    # Size batches from the average document size so each insert_many stays near 16MB
+                    try:
+                        stats = await _primary_db.command("collStats", name)
+                        avg_size = int(stats.get("avgObjSize") or 0)
+                    except Exception:
+                        avg_size = 0
+                    batch_size = BACKUP_MAX_BATCH_DOCS
+                    if avg_size:
+                        batch_size = max(1, min(BACKUP_MAX_BATCH_DOCS, BACKUP_MAX_BATCH_BYTES // avg_size))
+
+                    # Pull server-side batches straight into insert_many
+                    copied = 0
+                    target = secondary_db.get_collection(name, write_concern=BACKUP_WRITE_CONCERN)
+                    cursor = _primary_db[name].find({}, batch_size=batch_size)
+                    while batch := await cursor.to_list(batch_size):
+                        await target.insert_many(batch, ordered=False)
                         copied += len(batch)
-                        batch = []
-                if batch:
-                    await secondary_db[name].insert_many(batch, ordered=False)
-                    copied += len(batch)
-
-                summary[name] = copied
-                total_docs += copied
-                replication_manager.audit.info(f"backup_collection name={name} copied={copied}")
-            except Exception as coll_err:
-                # Record per-collection error but continue
-                summary[name] = {"error": str(coll_err)}
-                replication_manager.audit.error(f"backup_collection_error name={name} error={coll_err}")
+
+                    replication_manager.audit.info(f"backup_collection name={name} copied={copied}")
+                    return name, copied
+                except Exception as coll_err:
+                    # Record per-collection error but continue
+                    replication_manager.audit.error(f"backup_collection_error name={name} error={coll_err}")
+                    return name, {"error": str(coll_err)}
+
+        copy_sem = asyncio.Semaphore(BACKUP_COPY_CONCURRENCY)
+        results = await asyncio.gather(*(copy_collection(name) for name in coll_names))
+        summary = dict(results)
+        total_docs = sum(copied for copied in summary.values() if isinstance(copied, int))
 
         replication_manager.audit.info(f"backup_done collections={len(coll_names)} total_docs={total_docs}")
         return {
@@ -8437,9 +9186,13 @@ async def backup_full_database(current_user: User = Depends(get_current_admin)):
 
 @api_router.post("/admin/replication/toggle")
 async def toggle_replication(enable: bool, current_user: User = Depends(get_current_admin)):
-    cfg = load_config()
+    cfg = load_replication_config()
     cfg["replication_enabled"] = bool(enable)
-    save_config(cfg)
+    try:
+        await save_replication_config(cfg)
+    except Exception as exc:
+        logger.exception("Erro ao salvar configuração de replicação: %s", exc)
+        raise HTTPException(status_code=500, detail="Não foi possível salvar a configuração de replicação")
     await replication_manager.configure(cfg)
     return {"replication_enabled": replication_manager.enabled}
 
@@ -8450,9 +9203,11 @@ async def get_replication_logs(limit: int = 200, current_user: User = Depends(ge
     try:
         if not AUDIT_LOG_FILE.exists():
             return {"logs": []}
-        with AUDIT_LOG_FILE.open("r", encoding="utf-8") as f:
-            lines = f.readlines()
-        tail = lines[-limit:] if limit > 0 else lines
+        if limit > 0:
+            tail = tail_lines(AUDIT_LOG_FILE, limit)
+        else:
+            with AUDIT_LOG_FILE.open("r", encoding="utf-8") as f:
+                tail = f.readlines()
         return {"logs": [line.strip() for line in tail]}
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Erro ao ler logs: {exc}")
@@ -8462,8 +9217,9 @@ app.include_router(api_router)
 
 cors_origin_env = os.environ.get('CORS_ORIGINS')
 if cors_origin_env:
+    # Browsers send Origin without a trailing slash, so "https://app/" would never match
     cors_origins = [
-        origin.strip()
+        origin.strip().rstrip('/')
         for origin in cors_origin_env.split(',')
         if origin.strip()
     ]
@@ -8485,6 +9241,11 @@ if any(origin == "*" for origin in cors_origins):
     allow_credentials = False
     cors_origins = ["*"]
 
+# Precomputed for origin checks outside CORSMiddleware (e.g. a custom middleware): O(1) set
+# membership and a regex compiled once. Starlette takes the list and the pattern string below.
+cors_origins_set = frozenset(cors_origins)
+cors_origin_regex_compiled = re.compile(cors_origin_regex) if cors_origin_regex else None
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=allow_credentials,
@@ -8499,10 +9260,127 @@ async def ensure_certificate_share_indexes():
     await db.certificate_shares.create_index("expires_at", expireAfterSeconds=0)
 
 
+# Indexes backing hot lookups (Stripe webhook, auth). Partial filters keep
+# unique constraints from tripping over documents where the field is null.
+LOOKUP_INDEXES = [
+    ("email_outbox", [("status", 1), ("next_attempt_at", 1)], {}),
+    ("email_outbox", "claim_id", {}),
+    (
+        "email_outbox",
+        "idempotency_key",
+        {"unique": True, "partialFilterExpression": {"idempotency_key": {"$type": "string"}}},
+    ),
+    ("password_tokens", "token", {"unique": True}),
+    ("password_tokens", "token_history", {}),
+    ("password_tokens", "email", {}),
+    ("password_tokens", "expires_at", {}),
+    ("enrollments", [("user_id", 1), ("course_id", 1)], {}),
+    ("leads", "email", {}),
+    ("leads", "created_at", {}),
+    ("users", "id", {"unique": True}),
+    ("users", "email", {"unique": True}),
+    # Exact-match lookups keep using email_1; this one rejects case-only duplicates and
+    # serves the case-insensitive invite check in get_all_users
+    (
+        "users",
+        "email",
+        {"unique": True, "collation": EMAIL_CASE_INSENSITIVE_COLLATION, "name": "email_ci_unique"},
+    ),
+    ("users", "role", {}),
+    (
+        "users",
+        "stripe_customer_id",
+        {"unique": True, "partialFilterExpression": {"stripe_customer_id": {"$type": "string"}}},
+    ),
+    (
+        "subscription_plans",
+        "stripe_price_id",
+        {"unique": True, "partialFilterExpression": {"stripe_price_id": {"$type": "string"}}},
+    ),
+    ("billings", "billing_id", {"unique": True}),
+]
+
+
+@app.on_event("startup")
+async def ensure_lookup_indexes():
+    for collection_name, keys, options in LOOKUP_INDEXES:
+        try:
+            await db[collection_name].create_index(keys, background=True, **options)
+        except Exception as exc:
+            # Existing duplicates or option conflicts must not prevent startup
+            logger.warning("Could not ensure index %s on %s: %s", keys, collection_name, exc)
+
+
+@app.on_event("startup")
+async def warm_price_to_plan_cache():
+    try:
+        await load_price_to_plan()
+    except Exception as exc:
+        logger.warning("Could not warm stripe price -> plan cache: %s", exc)
+
+
+@app.on_event("startup")
+async def warm_email_config_cache():
+    await _get_email_config_async()
+
+
+@app.on_event("startup")
+async def start_email_outbox_drainer():
+    global _email_outbox_task
+    if _email_outbox_task is None:
+        _email_outbox_task = asyncio.create_task(_drain_email_outbox())
+
+
+@app.on_event("startup")
+async def start_lead_flusher():
+    global _lead_flush_task
+    if _lead_flush_task is None:
+        _lead_flush_task = asyncio.create_task(_flush_leads())
+
+
+@app.on_event("startup")
+async def start_status_forward_workers():
+    if not _forward_workers:
+        for _ in range(FORWARD_WORKER_COUNT):
+            _forward_workers.append(asyncio.create_task(_forward_status_worker()))
+
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in _forward_workers:
+        task.cancel()
+    _forward_workers.clear()
+    if _email_outbox_task is not None:
+        _email_outbox_task.cancel()
+    if _lead_flush_task is not None:
+        _lead_flush_task.cancel()
+        try:
+            await _lead_flush_task
+        except asyncio.CancelledError:
+            pass
+    await flush_pending_leads()
+    try:
+        flush_replication_config()
+    except Exception as exc:
+        logger.error("Failed to persist replication config on shutdown: %s", exc)
+    await billing_batcher.flush()
+    if _forward_http_client is not None:
+        await _forward_http_client.aclose()
+    if _brevo_http_client is not None:
+        await _brevo_http_client.aclose()
     client.close()
+    smtp_pool.close_all()
+    await async_smtp_pool.close_all()
+    stop_audit_listener()
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # "auto" picks uvloop and httptools when installed (not on Windows) and falls back otherwise
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="auto",
+        workers=int(os.environ.get("WEB_CONCURRENCY", "1")),
+    )
@@ -0,0 +1,309 @@
+import atexit
+import logging
+import queue
+import re
+import smtplib
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Optional, Tuple
+
+import aiosmtplib
+
+logger = logging.getLogger(__name__)
+
+# Server replies meaning the session is gone and the message can be retried on a new one
+RECONNECT_REPLY_CODES = {421}
+
+_BARE_EOL_RE = re.compile(r"(?:\r\n|\n|\r(?!\n))")
+
+
+class PipelinedSMTP(smtplib.SMTP):
+    """smtplib.SMTP that uses RFC 2920 PIPELINING when the server advertises it.
+
+    MAIL FROM and every RCPT TO are written back-to-back and their replies read
+    afterwards, saving a round-trip per command before DATA. Servers without
+    the extension get the stock sequential exchange.
+    """
+
+    def _abort(self, code: int) -> None:
+        if code == 421:
+            self.close()
+        else:
+            self._rset()
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn("pipelining"):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+
+        if isinstance(msg, str):
+            msg = _BARE_EOL_RE.sub("\r\n", msg).encode("ascii")
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        esmtp_opts = []
+        if self.has_extn("size"):
+            esmtp_opts.append("size=%d" % len(msg))
+        esmtp_opts.extend(mail_options)
+        mail_suffix = (" " + " ".join(esmtp_opts)) if esmtp_opts else ""
+        rcpt_suffix = (" " + " ".join(rcpt_options)) if rcpt_options else ""
+
+        self.putcmd("mail", "FROM:%s%s" % (smtplib.quoteaddr(from_addr), mail_suffix))
+        for addr in to_addrs:
+            self.putcmd("rcpt", "TO:%s%s" % (smtplib.quoteaddr(addr), rcpt_suffix))
+
+        code, resp = self.getreply()
+        if code != 250:
+            if code != 421:
+                # Consume the RCPT replies still in flight before resetting
+                for _ in to_addrs:
+                    self.getreply()
+            self._abort(code)
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+        refused = {}
+        for addr in to_addrs:
+            code, resp = self.getreply()
+            if code == 421:
+                self.close()
+                refused[addr] = (code, resp)
+                raise smtplib.SMTPRecipientsRefused(refused)
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(to_addrs):
+            self._rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, resp = self.data(msg)
+        if code != 250:
+            self._abort(code)
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+
+class PooledConnection:
+    def __init__(self, conn: smtplib.SMTP):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.messages_sent = 0
+
+
+class SMTPPool:
+    """Thread-safe pool of authenticated SMTP connections keyed by (server, port, username).
+
+    STARTTLS + LOGIN costs several round-trips per message, so idle connections
+    are kept open and handed out again. A connection is checked with NOOP before
+    reuse and recycled after ``max_messages`` sends or ``max_idle_seconds`` idle,
+    since relays drop long-lived sessions. Pooled connections are closed with
+    QUIT at interpreter exit.
+    """
+
+    def __init__(
+        self,
+        max_per_key: int = 5,
+        max_messages: int = 100,
+        max_idle_seconds: float = 60.0,
+        timeout: float = 30.0,
+        smtp_class=PipelinedSMTP,
+    ):
+        self.max_per_key = max_per_key
+        self.max_messages = max_messages
+        self.max_idle_seconds = max_idle_seconds
+        self.timeout = timeout
+        self.smtp_class = smtp_class
+        self._pools: Dict[Tuple[str, int, str], "queue.Queue[PooledConnection]"] = {}
+        self._lock = threading.Lock()
+        atexit.register(self.close_all)
+
+    @staticmethod
+    def _close(conn: smtplib.SMTP) -> None:
+        try:
+            conn.quit()
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _queue_for(self, key: Tuple[str, int, str]) -> "queue.Queue[PooledConnection]":
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = queue.Queue(maxsize=self.max_per_key)
+                self._pools[key] = pool
+            return pool
+
+    def _connect(self, smtp_server: str, smtp_port: int, username: str, password: str) -> PooledConnection:
+        conn = self.smtp_class(smtp_server, smtp_port, timeout=self.timeout)
+        try:
+            conn.starttls()
+            conn.login(username, password)
+        except Exception:
+            self._close(conn)
+            raise
+        return PooledConnection(conn)
+
+    def _checkout(self, pool: "queue.Queue[PooledConnection]") -> Optional[PooledConnection]:
+        while True:
+            try:
+                pooled = pool.get_nowait()
+            except queue.Empty:
+                return None
+            idle = time.monotonic() - pooled.last_used
+            if idle > self.max_idle_seconds or pooled.messages_sent >= self.max_messages:
+                self._close(pooled.conn)
+                continue
+            try:
+                if pooled.conn.noop()[0] == 250:
+                    return pooled
+            except Exception:
+                pass
+            self._close(pooled.conn)
+
+    def _release(self, pool: "queue.Queue[PooledConnection]", pooled: PooledConnection) -> None:
+        pooled.messages_sent += 1
+        pooled.last_used = time.monotonic()
+        if pooled.messages_sent >= self.max_messages:
+            self._close(pooled.conn)
+            return
+        try:
+            pool.put_nowait(pooled)
+        except queue.Full:
+            self._close(pooled.conn)
+
+    @contextmanager
+    def connection(self, smtp_server: str, smtp_port: int, username: str, password: str):
+        pool = self._queue_for((smtp_server, int(smtp_port), username))
+        pooled = self._checkout(pool) or self._connect(smtp_server, smtp_port, username, password)
+        try:
+            yield pooled.conn
+        except Exception:
+            # Connection state is unknown after a failed send; never reuse it
+            self._close(pooled.conn)
+            raise
+        self._release(pool, pooled)
+
+    def send_message(self, smtp_server: str, smtp_port: int, username: str, password: str, msg) -> None:
+        """Send ``msg`` on a pooled connection, retrying once if the server dropped the session."""
+        for attempt in range(2):
+            try:
+                with self.connection(smtp_server, smtp_port, username, password) as conn:
+                    conn.send_message(msg)
+                return
+            except smtplib.SMTPServerDisconnected:
+                if attempt:
+                    raise
+            except smtplib.SMTPResponseException as exc:
+                if attempt or exc.smtp_code not in RECONNECT_REPLY_CODES:
+                    raise
+            except smtplib.SMTPRecipientsRefused as exc:
+                # smtplib reports a 421 to RCPT as a refused recipient, but the session is gone
+                # and DATA was never sent, so the whole message can go out on a new connection
+                if attempt or not any(code in RECONNECT_REPLY_CODES for code, _ in exc.recipients.values()):
+                    raise
+            logger.info("SMTP session to %s:%s dropped; retrying on a new connection", smtp_server, smtp_port)
+
+    def close_all(self) -> None:
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            while True:
+                try:
+                    pooled = pool.get_nowait()
+                except queue.Empty:
+                    break
+                self._close(pooled.conn)
+
+
+class AsyncSMTPPool:
+    """aiosmtplib counterpart of SMTPPool for senders running on the event loop.
+
+    Any number of sends can be in flight at once; each borrows an idle
+    authenticated connection for its key or opens a new one, and up to
+    ``max_idle_per_key`` connections are kept for reuse afterwards.
+    """
+
+    def __init__(
+        self,
+        max_idle_per_key: int = 5,
+        max_messages: int = 100,
+        max_idle_seconds: float = 60.0,
+        timeout: float = 30.0,
+    ):
+        self.max_idle_per_key = max_idle_per_key
+        self.max_messages = max_messages
+        self.max_idle_seconds = max_idle_seconds
+        self.timeout = timeout
+        self._idle: Dict[Tuple[str, int, str], Deque[PooledConnection]] = {}
+
+    @staticmethod
+    async def _close(conn: aiosmtplib.SMTP) -> None:
+        try:
+            await conn.quit()
+        except Exception:
+            conn.close()
+
+    async def _connect(self, smtp_server: str, smtp_port: int, username: str, password: str) -> PooledConnection:
+        conn = aiosmtplib.SMTP(hostname=smtp_server, port=int(smtp_port), start_tls=True, timeout=self.timeout)
+        await conn.connect()
+        try:
+            await conn.login(username, password)
+        except Exception:
+            await self._close(conn)
+            raise
+        return PooledConnection(conn)
+
+    async def _checkout(self, key: Tuple[str, int, str]) -> Optional[PooledConnection]:
+        idle_conns = self._idle.get(key)
+        while idle_conns:
+            pooled = idle_conns.pop()
+            idle = time.monotonic() - pooled.last_used
+            if idle <= self.max_idle_seconds and pooled.messages_sent < self.max_messages:
+                try:
+                    if (await pooled.conn.noop()).code == 250:
+                        return pooled
+                except Exception:
+                    pass
+            await self._close(pooled.conn)
+        return None
+
+    async def _release(self, key: Tuple[str, int, str], pooled: PooledConnection) -> None:
+        pooled.messages_sent += 1
+        pooled.last_used = time.monotonic()
+        idle_conns = self._idle.setdefault(key, deque())
+        if pooled.messages_sent >= self.max_messages or len(idle_conns) >= self.max_idle_per_key:
+            await self._close(pooled.conn)
+            return
+        idle_conns.append(pooled)
+
+    async def send_message(self, smtp_server: str, smtp_port: int, username: str, password: str, msg) -> None:
+        """Send ``msg`` on a pooled connection, retrying once if the server dropped the session."""
+        key = (smtp_server, int(smtp_port), username)
+        for attempt in range(2):
+            pooled = await self._checkout(key) or await self._connect(smtp_server, smtp_port, username, password)
+            try:
+                await pooled.conn.send_message(msg)
+            except Exception as exc:
+                await self._close(pooled.conn)
+                dropped = (
+                    isinstance(exc, aiosmtplib.SMTPServerDisconnected)
+                    or (isinstance(exc, aiosmtplib.SMTPResponseException) and exc.code in RECONNECT_REPLY_CODES)
+                    or (
+                        isinstance(exc, aiosmtplib.SMTPRecipientsRefused)
+                        and any(refused.code in RECONNECT_REPLY_CODES for refused in exc.recipients)
+                    )
+                )
+                if attempt or not dropped:
+                    raise
+                logger.info("SMTP session to %s:%s dropped; retrying on a new connection", smtp_server, smtp_port)
+                continue
+            await self._release(key, pooled)
+            return
+
+    async def close_all(self) -> None:
+        idle, self._idle = self._idle, {}
+        for idle_conns in idle.values():
+            for pooled in idle_conns:
+                await self._close(pooled.conn)